@@ -11,6 +11,7 @@ from astropy.time import Time
 from astroquery.mast import Catalogs  # for querying the Mikulski Archive for Space Telescopes (MAST)
 import time
 import matplotlib.pyplot as plt
+from FFIConfig import DEFAULT_CONFIG
 
 
 def closest_source(sources, position):
@@ -85,20 +86,21 @@ def add_tic_ids(df):
     return df
 
 
-def perform_photometry(data, sources):
+def perform_photometry(data, sources, radius=DEFAULT_CONFIG.aperture_radius):
     """
     This function performs aperture photometry on an image for a given list of sources.
 
     Parameters:
     - data: A 2D numpy array representing the image data.
     - sources: A table of identified sources, where each source has 'xcentroid' and 'ycentroid' properties.
+    - radius: The aperture radius, in pixels.
 
     The zip function combines the 'xcentroid' and 'ycentroid' arrays into pairs of coordinates,
     and list converts it into a list of tuples.
     The function returns a table with the photometry results for each source.
     """
     positions = list(zip(sources['xcentroid'], sources['ycentroid']))
-    apertures = CircularAperture(positions, r=3.)  # r can be modified
+    apertures = CircularAperture(positions, r=radius)
     phot_table = aperture_photometry(data, apertures)
 
     return phot_table
@@ -156,12 +158,13 @@ def format_time(time_string):
     return classic_time
 
 
-def process_fits_file(fits_file):
+def process_fits_file(fits_file, config=DEFAULT_CONFIG):
     """
     This function processes a FITS file and performs photometry on the sources found in the image.
 
     Parameters:
     - fits_file: The path to the FITS file to process.
+    - config: The PhotometryConfig with the sigma, fwhm, threshold and aperture radius (see FFIConfig).
 
     The function opens the FITS file, reads the image data, estimates the background and background noise, finds the
     sources in the image using DAOStarFinder, performs aperture photometry on the sources, calculates the exposure
@@ -178,7 +181,7 @@ def process_fits_file(fits_file):
 
 
         # Estimate the background and background noise
-        mean, median, std = sigma_clipped_stats(data, sigma=3.0)  # sigma=3.0 means that any data point that is more than 3 standard deviations away from the mean will be considered an outlier and excluded from the calculations
+        mean, median, std = sigma_clipped_stats(data, sigma=config.sigma)  # sigma=3.0 means that any data point that is more than 3 standard deviations away from the mean will be considered an outlier and excluded from the calculations
         # mean - the average pixel value in the image
         # median - the middle pixel value when all the values are sorted
         # std - measure of the spread of pixel values around the mean
@@ -195,11 +198,11 @@ def process_fits_file(fits_file):
         than the background
         """
         # Find the stars in the image
-        daofind = DAOStarFinder(fwhm=5.0, threshold=3. * std)  # fwhm can be modified
+        daofind = DAOStarFinder(fwhm=config.fwhm, threshold=config.threshold * std)
         sources = daofind(data - median)
 
         # Perform aperture photometry
-        phot_table = perform_photometry(data, sources)
+        phot_table = perform_photometry(data, sources, config.aperture_radius)
 
 
 
@@ -210,7 +213,7 @@ def process_fits_file(fits_file):
         phot_table = calculate_flux(phot_table, exposure_time)
 
         # Estimate the number of pixels in the aperture
-        n_pixels = np.pi * 3 ** 2  # This assumes a circular aperture with a radius of 3 pixels
+        n_pixels = np.pi * config.aperture_radius ** 2  # This assumes a circular aperture
 
         # Extract the gain from the header
         gainA = hdu[1].header['GAINA']
@@ -245,7 +248,7 @@ def main():
 
         # Perform aperture photometry on all stars
         positions = [(source['xcentroid'], source['ycentroid']) for source in sources]
-        apertures = CircularAperture(positions, r=3.)
+        apertures = CircularAperture(positions, r=DEFAULT_CONFIG.aperture_radius)
         phot_table = aperture_photometry(data, apertures)
 
         # Add the time of the observation to the photometry table
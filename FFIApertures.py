@@ -0,0 +1,105 @@
+import numpy as np
+import scipy.sparse as sp
+from photutils.aperture import CircularAperture
+
+
+def aperture_matrix(positions, radius, shape):
+    """
+    This function computes the weights of circular apertures as a sparse matrix.
+
+    Parameters:
+    - positions: An (n_sources, 2) array of (x, y) aperture centres, in pixels.
+    - radius: The aperture radius, in pixels.
+    - shape: The (rows, columns) shape of the images.
+
+    The weights are the exact fractions of each pixel inside each circle, from photutils (method='exact', the
+    default of aperture_photometry), so the sums are the same as those of aperture_photometry. Only the pixels that
+    are inside at least one aperture are kept: the function returns the (n_sources, n_pixels) CSR matrix and the
+    flat indices of these n_pixels pixels in the image.
+    """
+    rows, cols, weights = [], [], []
+    for k, mask in enumerate(CircularAperture(positions, r=radius).to_mask(method='exact')):
+        large, small = mask.get_overlap_slices(shape)
+        if large is None:
+            continue  # the aperture is outside of the image
+        w = mask.data[small]
+        yy, xx = np.mgrid[large[0], large[1]]
+        inside = w > 0
+        rows.append(np.full(np.count_nonzero(inside), k))
+        cols.append((yy * shape[1] + xx)[inside])
+        weights.append(w[inside])
+
+    if not rows:
+        return sp.csr_matrix((len(positions), 0)), np.zeros(0, dtype=np.int64)
+    pixels, columns = np.unique(np.concatenate(cols), return_inverse=True)
+    matrix = sp.csr_matrix((np.concatenate(weights), (np.concatenate(rows), columns)),
+                           shape=(len(positions), len(pixels)))
+    return matrix, pixels
+
+
+class ApertureMatrix:
+    """
+    This class performs aperture photometry on blocks of images with a sparse matrix of aperture weights.
+
+    Parameters:
+    - radius: The aperture radius, in pixels.
+    - shape: The (rows, columns) shape of the images.
+    - tolerance: The largest move, in pixels, of an aperture before the weights are computed again.
+
+    The exact circle/pixel overlaps are computed once (aperture_matrix) and kept while the positions stay within the
+    tolerance. The sums of a whole block of images are then one product of the sparse weights with the aperture
+    pixels of all the images, gathered from the (possibly memory-mapped) stack, instead of recomputing the overlaps
+    for every source of every image. 'updates' counts how many times the weights were computed.
+    """
+
+    def __init__(self, radius, shape, tolerance=0.05):
+        self.radius = radius
+        self.shape = tuple(shape)
+        self.tolerance = tolerance
+        self.positions = None
+        self.matrix = None
+        self.pixels = None
+        self.updates = 0
+
+    def set_positions(self, positions):
+        """
+        This method computes the weights for the given positions, unless no aperture moved by more than tolerance
+        since they were last computed. It returns the positions the weights are computed for.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        if (self.positions is None or positions.shape != self.positions.shape
+                or np.abs(positions - self.positions).max(initial=0) > self.tolerance):
+            self.matrix, self.pixels = aperture_matrix(positions, self.radius, self.shape)
+            self.positions = positions
+            self.updates += 1
+        return self.positions
+
+    def photometry(self, frames):
+        """
+        This method returns the (n_frames, n_sources) aperture sums of a (n_frames, rows, columns) block of images.
+        """
+        flat = np.asarray(frames).reshape(len(frames), -1)
+        return np.asarray(self.matrix @ flat[:, self.pixels].T.astype(np.float64)).T
+
+
+def frame_blocks(shifts, tolerance=0.05, block_size=16):
+    """
+    This function splits the frames into blocks of at most block_size consecutive frames that can share the same
+    aperture weights, and returns their (start, stop, anchor) ranges.
+
+    The weights of a block are computed for the shift of its anchor frame, and every frame of the block has a
+    (dx, dy) shift within tolerance of it. A block that ends because it is full keeps its anchor for the next block,
+    so the weights are only computed again when a frame moves by more than tolerance from the shift they were
+    computed for, never from the start of a block.
+    """
+    shifts = np.asarray(shifts)
+    blocks = []
+    start = anchor = 0
+    for i in range(1, len(shifts) + 1):
+        moved = i < len(shifts) and np.abs(shifts[i] - shifts[anchor]).max() > tolerance
+        if i == len(shifts) or i - start == block_size or moved:
+            blocks.append((start, i, anchor))
+            start = i
+            if moved:
+                anchor = i
+    return blocks
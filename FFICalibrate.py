@@ -3,31 +3,246 @@ import os
 import numpy as np
 from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
+from numpy.lib.format import open_memmap
+from scipy.ndimage import maximum_filter
 
 
-def calibrate_background(fits_files):
-    data_arrays = []
+def background_stats(data, sigma=3.0):
+    """
+    This function estimates the background of a single image with sigma-clipped statistics and returns the
+    mean, median and standard deviation of the background.
+    """
+    mean, median, std = sigma_clipped_stats(data, sigma=sigma)
+    return mean, median, std
+
+
+def calibrate_background(fits_files, reject_outliers=True):
+    calibrated_files = []
     means = []
     medians = []
     stds = []
 
     save_path = 'calibrated_data'  # Directory where you want to save the files
     os.makedirs(save_path, exist_ok=True)  # Create the directory if it doesn't exist
+    cube_path = os.path.join(save_path, 'data_arrays.npy')
 
+    # The images are written one by one into a memory-mapped .npy file, so the whole sector never has to fit in memory
+    cube = None
+    camera, ccd = None, None
     for fits_file in fits_files:
         try:
             with fits.open(fits_file, mode='readonly') as hdu:
                 data = hdu[1].data
-                mean, median, std = sigma_clipped_stats(data, sigma=3.0)
-                data_arrays.append(data)
+                if cube is None:
+                    cube = open_memmap(cube_path, mode='w+', dtype=np.float32, shape=(len(fits_files),) + data.shape)
+                    camera, ccd = hdu[0].header.get('CAMERA'), hdu[0].header.get('CCD')
+                elif data.shape != cube.shape[1:]:
+                    raise ValueError(f"image shape {data.shape} differs from {cube.shape[1:]}")
+                mean, median, std = background_stats(data)
+                cube[len(means)] = data
+                calibrated_files.append(fits_file)
                 means.append(mean)
                 medians.append(median)
                 stds.append(std)
         except Exception as e:
             print(f"Failed to process {fits_file}: {e}")
 
+    if cube is not None:
+        cube.flush()
+        del cube
+        if len(means) < len(fits_files):
+            _truncate_cube(cube_path, len(means))
+
     # Save the arrays to the specified directory
-    np.save(os.path.join(save_path, 'data_arrays.npy'), data_arrays)
     np.save(os.path.join(save_path, 'means.npy'), means)
     np.save(os.path.join(save_path, 'medians.npy'), medians)
     np.save(os.path.join(save_path, 'stds.npy'), stds)
+    # The files of the images in the stack, in order (the files that failed to load are not in it)
+    np.save(os.path.join(save_path, 'fits_files.npy'), np.array(calibrated_files, dtype=str))
+
+    # Remove cosmic rays and hot pixels
+    if reject_outliers and len(means) > 0:
+        mask_path = os.path.join('hot_pixel_masks', f'hot_pixels_{camera}-{ccd}.npy')
+        reject_temporal_outliers(cube_path, mask_path=mask_path)
+
+
+def load_calibrated_data(fits_files, save_path='calibrated_data'):
+    """
+    This function loads the calibrated images and background statistics of the given files.
+
+    The stack saved by calibrate_background is memory-mapped, so only the images being processed are read from
+    disk. The images are selected by file name, not by position, so fits_files can be a subset of the calibrated
+    files (e.g. the usable frames after the triage) or in another order. The files that were not calibrated are
+    skipped.
+
+    The function returns the selected files (in the order of fits_files), their images (a list of memory-mapped
+    views), and their means, medians and standard deviations.
+    """
+    list_path = os.path.join(save_path, 'fits_files.npy')
+    if not os.path.exists(list_path):
+        raise FileNotFoundError(f"{list_path} not found, calibrate the images again")
+    position = {fits_file: i for i, fits_file in enumerate(np.load(list_path))}
+    selected = [fits_file for fits_file in fits_files if fits_file in position]
+    if len(selected) < len(fits_files):
+        print(f"{len(fits_files) - len(selected)} of the {len(fits_files)} files are not calibrated, skipping them")
+    idx = np.array([position[fits_file] for fits_file in selected], dtype=int)
+
+    cube = np.load(os.path.join(save_path, 'data_arrays.npy'), mmap_mode='r')
+    means = np.load(os.path.join(save_path, 'means.npy'))[idx]
+    medians = np.load(os.path.join(save_path, 'medians.npy'))[idx]
+    stds = np.load(os.path.join(save_path, 'stds.npy'))[idx]
+    return selected, [cube[i] for i in idx], means, medians, stds
+
+
+def rolling_median(cube, window):
+    """
+    This function computes the running median of a (time, rows, columns) array along the time axis.
+
+    Parameters:
+    - cube: A 3D numpy array with the time on the first axis.
+    - window: The (odd) number of frames in the running window.
+
+    The median of each frame is taken over the window - 1 frames around it, leaving the frame itself out, so that an
+    outlier never pulls its own baseline up. Near the ends of the time series the window is moved inwards instead of
+    padded, so the first and last frames are compared with window - 1 real frames, not mirrored copies of their
+    neighbours.
+    """
+    n_frames = len(cube)
+    frames = np.arange(n_frames)
+    start = np.clip(frames - window // 2, 0, n_frames - window)
+    members = start[:, None] + np.arange(window)
+    neighbours = members[members != frames[:, None]].reshape(n_frames, window - 1)
+    return np.median(cube[neighbours], axis=1)
+
+
+def reject_temporal_outliers(cube_path, window=5, nsigma=5.0, hot_fraction=0.5, mask_path=None,
+                             chunk_memory_mb=256):
+    """
+    This function flags and replaces cosmic rays and hot pixels in a stack of images saved as a .npy file.
+
+    Parameters:
+    - cube_path: The path to the (time, rows, columns) .npy file. It is cleaned in place.
+    - window: The number of frames of the running median (odd, at least 3).
+    - nsigma: A pixel is an outlier when it is more than nsigma robust standard deviations above its running median.
+    - hot_fraction: A pixel flagged in more than this fraction of the frames is added to the hot pixel mask.
+    - mask_path: The path of the persistent hot pixel mask. An existing mask (e.g. from another sector of the same
+      camera/CCD) is applied and updated with the new hot pixels. If None, no mask is read or saved.
+    - chunk_memory_mb: The memory budget, in megabytes, of one chunk of rows.
+
+    Cosmic rays last a single frame, so along the time axis they stand out of the running median of their pixel.
+    The running median, and the MAD (median absolute deviation, times 1.4826 for a robust standard deviation) of
+    each pixel around it, are computed with NumPy on chunks of full rows of all frames, so the stack is read and
+    written once, chunk by chunk, and never has to fit in memory. The MAD of a pixel over a short time series is
+    noisy, so it is floored by the noise of the frame (the MAD of all the pixels of the chunk in that frame), or
+    pure noise would be clipped far more often than nsigma allows. In the stars, the pixels also change when the
+    star moves slightly from frame to frame, so there a pixel is only a cosmic ray if it is a spatial outlier too,
+    with the same test as the hot pixels below on its deviation from the running median. Outliers are replaced by
+    their running median.
+
+    Hot pixels are high in every frame, so they are found spatially on the temporal median image: a pixel is hot if
+    it is more than nsigma robust standard deviations above the background while its 4 direct neighbours are not
+    (a star spreads over its neighbours, a hot pixel does not). They are replaced in every frame by the mean of their
+    left and right neighbours in the same row.
+
+    The function returns the hot pixel mask and the number of replaced cosmic ray pixels.
+    """
+    cube = np.load(cube_path, mmap_mode='r+')
+    n_frames, n_rows, n_cols = cube.shape
+
+    # The window cannot be longer than the time series
+    window = min(window, n_frames if n_frames % 2 == 1 else n_frames - 1)
+
+    hot_mask = np.zeros((n_rows, n_cols), dtype=bool)
+    if mask_path is not None and os.path.exists(mask_path):
+        saved_mask = np.load(mask_path)
+        if saved_mask.shape == hot_mask.shape:
+            hot_mask |= saved_mask
+
+    # Number of rows in one chunk: the chunk, its running median, MAD and neighbours, and the window copies made by
+    # np.median
+    bytes_per_row = n_frames * n_cols * 4 * (window + 5)
+    chunk_rows = max(1, (chunk_memory_mb * 1024 ** 2) // bytes_per_row)
+
+    # Pass 1: temporal median image, for the hot pixels
+    median_image = np.empty((n_rows, n_cols), dtype=np.float32)
+    for r0 in range(0, n_rows, chunk_rows):
+        median_image[r0:r0 + chunk_rows] = np.median(cube[:, r0:r0 + chunk_rows], axis=0)
+    background = np.median(median_image)
+    excess = median_image - background
+    noise = 1.4826 * np.median(np.abs(excess))
+    # Highest of the 4 direct neighbours; they are part of the PSF of a star but stay at the background for a hot pixel
+    neighbours = maximum_filter(excess, footprint=[[0, 1, 0], [1, 0, 1], [0, 1, 0]], mode='nearest')
+    hot_mask |= (excess > nsigma * noise) & (neighbours < 0.1 * excess)
+    # The stars and their wings
+    star_mask = maximum_filter(excess > nsigma * noise, size=3)
+
+    # Pass 2: cosmic rays, and replacement of the hot pixels
+    flag_counts = np.zeros((n_rows, n_cols), dtype=np.int32)
+    n_replaced = 0
+    for r0 in range(0, n_rows, chunk_rows):
+        r1 = min(r0 + chunk_rows, n_rows)
+        # One more row on each side, so the pixels of the first and last rows have their 4 neighbours
+        h0, h1 = max(r0 - 1, 0), min(r1 + 1, n_rows)
+        chunk = np.array(cube[:, h0:h1], dtype=np.float32)
+        chunk_hot = hot_mask[h0:h1]
+
+        if window >= 3:
+            running_median = rolling_median(chunk, window)
+            deviation = chunk - running_median
+            # A MAD over a few frames is too noisy to threshold against, so it is taken over the whole time series
+            # and floored by the noise of the frame
+            frame_noise = 1.4826 * np.median(np.abs(deviation), axis=(1, 2), keepdims=True)
+            sigma = np.maximum(1.4826 * np.median(np.abs(deviation), axis=0), frame_noise)
+            outliers = (deviation > nsigma * sigma) & (sigma > 0) & ~chunk_hot
+            # In a star, only the pixels whose 4 neighbours did not rise with them (a moving star spreads over them)
+            neighbours = maximum_filter(deviation, footprint=[[[0, 1, 0], [1, 0, 1], [0, 1, 0]]], mode='nearest')
+            outliers &= ~star_mask[h0:h1] | (neighbours < 0.1 * deviation)
+            outliers[:, :r0 - h0] = False
+            outliers[:, r1 - h0:] = False
+            chunk[outliers] = running_median[outliers]
+            flag_counts[r0:r1] = outliers[:, r0 - h0:r1 - h0].sum(axis=0)
+            n_replaced += int(outliers.sum())
+
+        chunk = chunk[:, r0 - h0:r1 - h0]
+        _replace_hot_pixels(chunk, chunk_hot[r0 - h0:r1 - h0])
+        cube[:, r0:r1] = chunk
+
+    cube.flush()
+    del cube
+
+    # Pixels hit in most frames are not cosmic rays but flickering hot pixels
+    hot_mask |= flag_counts > hot_fraction * n_frames
+    if mask_path is not None:
+        os.makedirs(os.path.dirname(mask_path) or '.', exist_ok=True)
+        np.save(mask_path, hot_mask)
+
+    print(f"Replaced {n_replaced} cosmic ray pixels and {int(hot_mask.sum())} hot pixels")
+    return hot_mask, n_replaced
+
+
+def _replace_hot_pixels(chunk, chunk_hot):
+    """
+    This function replaces the hot pixels of a (time, rows, columns) chunk by the mean of their left and right
+    neighbours in the same row, in every frame.
+    """
+    rows, cols = np.nonzero(chunk_hot)
+    if len(rows) == 0:
+        return
+    n_cols = chunk.shape[2]
+    left = np.clip(cols - 1, 0, n_cols - 1)
+    right = np.clip(cols + 1, 0, n_cols - 1)
+    chunk[:, rows, cols] = (chunk[:, rows, left] + chunk[:, rows, right]) / 2
+
+
+def _truncate_cube(cube_path, n_frames):
+    """
+    This function keeps only the first n_frames images of a .npy stack (used when some files failed to load).
+    """
+    cube = np.load(cube_path, mmap_mode='r')
+    tmp_path = cube_path + '.tmp.npy'
+    truncated = open_memmap(tmp_path, mode='w+', dtype=cube.dtype, shape=(n_frames,) + cube.shape[1:])
+    for i in range(n_frames):
+        truncated[i] = cube[i]
+    truncated.flush()
+    del truncated, cube
+    os.replace(tmp_path, cube_path)
@@ -0,0 +1,61 @@
+import itertools
+from dataclasses import asdict, dataclass, replace
+
+
+@dataclass(frozen=True)
+class PhotometryConfig:
+    """
+    This class holds the parameters of the background estimation, the star detection and the photometry.
+
+    - sigma: The clipping limit of the sigma-clipped background statistics, in standard deviations.
+    - detector: The name of the detector backend, 'dao' (DAOStarFinder) or 'fast' (see FFIDetector).
+    - fwhm: The FWHM of the stars, in pixels.
+    - threshold: The detection threshold, in units of the background standard deviation.
+    - aperture_radius: The radius, in pixels, of the aperture of the final photometry.
+    - growth_radii: The aperture radii of the curve of growth.
+
+    The defaults are the values the pipeline has always used. The configuration is frozen (immutable), so it can be
+    used as a dictionary key; use with_values to change some of the parameters.
+    """
+    sigma: float = 3.0
+    detector: str = 'dao'
+    fwhm: float = 5.0
+    threshold: float = 3.0
+    aperture_radius: float = 3.0
+    growth_radii: tuple = tuple(range(1, 10))
+
+    def with_values(self, **values):
+        """
+        This method returns a copy of the configuration with some parameters changed.
+        """
+        return replace(self, **values)
+
+    def background_key(self):
+        """
+        The parameters the background statistics depend on.
+        """
+        return {'sigma': self.sigma}
+
+    def detection_key(self):
+        """
+        The parameters the detected sources depend on.
+        """
+        return dict(self.background_key(), detector=self.detector, fwhm=self.fwhm, threshold=self.threshold)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+DEFAULT_CONFIG = PhotometryConfig()
+
+
+def config_grid(base=DEFAULT_CONFIG, **values):
+    """
+    This function returns the configurations of every combination of the given parameter values.
+
+    For example config_grid(threshold=[3, 5], aperture_radius=[2, 3, 4]) returns 6 configurations, with the other
+    parameters taken from base.
+    """
+    names = list(values)
+    return [base.with_values(**dict(zip(names, combination)))
+            for combination in itertools.product(*(values[name] for name in names))]
@@ -0,0 +1,236 @@
+import time
+
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+from photutils.detection import DAOStarFinder
+from scipy.ndimage import convolve1d, uniform_filter
+from scipy.spatial import cKDTree
+
+
+def dao_detect(data, median, std, fwhm=5.0, threshold=3.0):
+    """
+    This function finds the stars in an image with DAOStarFinder.
+
+    Parameters:
+    - data: A 2D numpy array representing the image data.
+    - median: The median background level of the image.
+    - std: The standard deviation of the background noise in the image.
+    - fwhm: The FWHM of the stars, in pixels.
+    - threshold: The detection threshold, in units of the background standard deviation.
+    """
+    """
+    The DAOStarFinder class implements the DAOFIND algorithm (Stetson, 1987) which uses a wavelet transform of
+    the input image to calculate the local mean and standard deviation, and then selects sources where the
+    wavelet-transformed image is larger than a certain threshold above the local background.
+    The FWHM=5.0 (Full Width at Half Maximum) is a measure of the extent of a function, given by the difference
+    between the two extreme values of the independent variable at which the dependent variable is equal to half of
+    its maximum value.
+    The threshold=3. (limit for detection of the stars) is a value above which a star will be detected
+    This means that for a local peak to be considered a star, it must be at least 3 standard deviations brighter
+    than the background
+    """
+    daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold * std)  # fwhm can be modified
+    return daofind(data - median)
+
+
+def fast_detect(data, median, std, fwhm=5.0, threshold=3.0, sharplo=0.2, sharphi=1.0, roundlo=-1.0, roundhi=1.0):
+    """
+    This function finds the stars in an image with a faster, simplified version of the DAOFIND algorithm.
+
+    The parameters are the same as dao_detect, plus the DAOStarFinder limits on sharpness and roundness.
+
+    1. The background-subtracted image is convolved with a Gaussian of the given FWHM. The Gaussian is separable, so
+       the 2D convolution is done as two 1D convolutions (rows then columns) instead of one 2D convolution, and the
+       local mean is subtracted with a box filter (also separable), like the "lowered" kernel of DAOFIND.
+    2. Candidates are the pixels above the threshold that are the maximum of their kernel box.
+    3. Only for the candidates, vectorized over all of them: the exact DAOFIND convolved peak (so the threshold,
+       sharpness and flux are on the same scale as DAOStarFinder), the centroid (parabolic interpolation of the
+       convolved peak), the sharpness and the roundness (from the heights of the x and y marginals, as roundness2 in
+       DAOStarFinder).
+
+    The function returns a table with the same main columns as DAOStarFinder ('xcentroid', 'ycentroid', 'sharpness',
+    'roundness2', 'peak', 'flux', 'mag'), or None if no star is found.
+    """
+    image = np.asarray(data, dtype=np.float32) - np.float32(median)
+    sigma = fwhm / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+    half = max(2, int(1.5 * sigma))
+    box = 2 * half + 1
+
+    # 1D Gaussian (peak value 1); the 2D kernel is its outer product
+    offsets = np.arange(-half, half + 1)
+    g = np.exp(-offsets ** 2 / (2 * sigma ** 2)).astype(np.float32)
+
+    # The DAOFIND kernel: the same Gaussian, limited to a circle and lowered to zero sum. relerr converts the
+    # threshold in std units to a threshold on the convolved image, exactly as in DAOStarFinder.
+    footprint = (offsets[:, None] ** 2 + offsets[None, :] ** 2) <= max((1.5 * sigma) ** 2, 4.0)
+    dao_gaussian = np.outer(g, g) * footprint
+    denom = np.sum(dao_gaussian ** 2) - np.sum(dao_gaussian) ** 2 / footprint.sum()
+    dao_kernel = (dao_gaussian - np.sum(dao_gaussian) / footprint.sum()) / denom * footprint
+    threshold_eff = threshold * std / np.sqrt(denom)
+
+    # Separable approximation of the DAOFIND convolution on the full image: Gaussian rows then columns, minus the
+    # box mean (also separable) so that blended neighbours stay separate peaks, scaled so that a Gaussian star of
+    # amplitude A gives about A. It is only used to find the candidates, the exact DAOFIND value is computed below.
+    k = g / np.sum(g ** 2)
+    sum_k = np.sum(k) ** 2
+    lowered = 1 - sum_k * np.sum(g) ** 2 / box ** 2
+    convolved = convolve1d(convolve1d(image, k, axis=0, mode='nearest'), k, axis=1, mode='nearest')
+    amplitude = (convolved - sum_k * uniform_filter(image, size=box, mode='nearest')) / lowered
+
+    # Candidates: pixels above (half) the threshold, away from the edges, that are the maximum of their kernel box.
+    # The maximum is only checked around these pixels instead of filtering the full image.
+    above = amplitude > 0.5 * threshold_eff
+    above[:half + 1] = False
+    above[-half - 1:] = False
+    above[:, :half + 1] = False
+    above[:, -half - 1:] = False
+    ys, xs = np.nonzero(above)
+    windows = amplitude[ys[:, None, None] + offsets[None, :, None], xs[:, None, None] + offsets[None, None, :]]
+    is_peak = amplitude[ys, xs] >= windows.max(axis=(1, 2))
+    ys, xs = ys[is_peak], xs[is_peak]
+    if len(ys) == 0:
+        return None
+
+    # Sub-pixel centroid from a parabola through the convolved peak and its neighbours
+    a0 = amplitude[ys, xs]
+    dx = _parabola_offset(amplitude[ys, xs - 1], a0, amplitude[ys, xs + 1])
+    dy = _parabola_offset(amplitude[ys - 1, xs], a0, amplitude[ys + 1, xs])
+
+    # (candidates, box, box) cutouts of the background-subtracted image, and the exact DAOFIND convolved peak
+    cutouts = image[ys[:, None, None] + offsets[None, :, None], xs[:, None, None] + offsets[None, None, :]]
+    center = cutouts[:, half, half]
+    convolved_peak = np.einsum('nij,ij->n', cutouts, dao_kernel)
+
+    # Sharpness: the central pixel above the mean of the others inside the kernel footprint, relative to the peak
+    others = ((cutouts * footprint).sum(axis=(1, 2)) - center) / (footprint.sum() - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpness = (center - others) / convolved_peak
+
+    # Roundness: heights of the Gaussians fitted (linear least squares) to the x and y marginals
+    g_low = g - g.mean()
+    x_marginal = cutouts.sum(axis=1)
+    y_marginal = cutouts.sum(axis=2)
+    hx = ((x_marginal - x_marginal.mean(axis=1, keepdims=True)) * g_low).sum(axis=1) / np.sum(g_low ** 2)
+    hy = ((y_marginal - y_marginal.mean(axis=1, keepdims=True)) * g_low).sum(axis=1) / np.sum(g_low ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roundness = 2 * (hx - hy) / (hx + hy)
+
+    keep = ((convolved_peak > threshold_eff) & (sharpness > sharplo) & (sharpness < sharphi)
+            & (roundness > roundlo) & (roundness < roundhi) & (hx > 0) & (hy > 0))
+    if not np.any(keep):
+        return None
+
+    flux = convolved_peak[keep] / threshold_eff  # DAOFIND's definition of the flux
+    sources = Table()
+    sources['id'] = np.arange(1, np.count_nonzero(keep) + 1)
+    sources['xcentroid'] = xs[keep] + dx[keep]
+    sources['ycentroid'] = ys[keep] + dy[keep]
+    sources['sharpness'] = sharpness[keep]
+    sources['roundness2'] = roundness[keep]
+    sources['npix'] = int(footprint.sum())
+    sources['peak'] = cutouts[keep].max(axis=(1, 2))
+    sources['flux'] = flux
+    with np.errstate(divide='ignore'):
+        sources['mag'] = -2.5 * np.log10(flux)
+    return sources
+
+
+# The detector backends, selected by name with the `detector` parameter of the star finding functions
+DETECTORS = {
+    'dao': dao_detect,
+    'fast': fast_detect,
+}
+
+
+def get_detector(name):
+    """
+    This function returns the detector backend with the given name ('dao' or 'fast').
+    """
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown detector '{name}', choose one of: {', '.join(DETECTORS)}")
+    return DETECTORS[name]
+
+
+def match_sources(ref_xy, new_xy, match_radius):
+    """
+    This function matches two lists of (x, y) positions one to one and returns the distances of the matched pairs.
+
+    A pair is matched when each source is the nearest neighbour of the other and they are closer than match_radius,
+    so a source is never counted twice when several sources of the other list are close to it.
+    """
+    new_distances, new_nearest = cKDTree(ref_xy).query(new_xy, distance_upper_bound=match_radius)
+    _, ref_nearest = cKDTree(new_xy).query(ref_xy, distance_upper_bound=match_radius)
+    matched = np.flatnonzero(np.isfinite(new_distances))
+    matched = matched[ref_nearest[new_nearest[matched]] == matched]
+    return new_distances[matched]
+
+
+def compare_detectors(fits_files, data_arrays, medians, stds, reference='dao', candidate='fast', match_radius=1.5,
+                      save_path='calibrated_data'):
+    """
+    This function runs two detector backends on the same images and compares their catalogs.
+
+    Parameters:
+    - fits_files: The paths to the FITS files (used to name the rows of the report).
+    - data_arrays: The image data of each file.
+    - medians: The median background level of each image.
+    - stds: The standard deviation of the background noise of each image.
+    - reference, candidate: The names of the two backends to compare.
+    - match_radius: Two sources closer than this, in pixels, are the same star.
+    - save_path: The directory where the report is saved as detector_validation.csv.
+
+    For each image the report gives the number of sources found by each backend, the number matched one to one (see
+    match_sources), the completeness (matched / reference sources), the purity (matched / candidate sources), the
+    median offset between matched centroids, and the run time of each backend.
+    """
+    rows = []
+    for fits_file, data, median, std in zip(fits_files, data_arrays, medians, stds):
+        data = np.asarray(data)
+
+        start = time.perf_counter()
+        ref_sources = get_detector(reference)(data, median, std)
+        ref_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new_sources = get_detector(candidate)(data, median, std)
+        new_seconds = time.perf_counter() - start
+
+        n_ref = 0 if ref_sources is None else len(ref_sources)
+        n_new = 0 if new_sources is None else len(new_sources)
+        n_matched, offset = 0, np.nan
+        if n_ref > 0 and n_new > 0:
+            distances = match_sources(np.column_stack([ref_sources['xcentroid'], ref_sources['ycentroid']]),
+                                      np.column_stack([new_sources['xcentroid'], new_sources['ycentroid']]),
+                                      match_radius)
+            n_matched = len(distances)
+            if n_matched > 0:
+                offset = float(np.median(distances))
+
+        rows.append({
+            'file': fits_file,
+            f'n_{reference}': n_ref,
+            f'n_{candidate}': n_new,
+            'n_matched': n_matched,
+            'completeness': n_matched / n_ref if n_ref else np.nan,
+            'purity': n_matched / n_new if n_new else np.nan,
+            'median_offset': offset,
+            f'{reference}_seconds': ref_seconds,
+            f'{candidate}_seconds': new_seconds,
+        })
+
+    report = pd.DataFrame(rows)
+    report.to_csv(f'{save_path}/detector_validation.csv', index=False)
+    print(f"completeness {report['completeness'].mean():.3f}, purity {report['purity'].mean():.3f}, "
+          f"speedup x{report[f'{reference}_seconds'].sum() / report[f'{candidate}_seconds'].sum():.1f}")
+    return report
+
+
+def _parabola_offset(left, center, right):
+    """
+    This function returns the offset of the vertex of the parabola through three equally spaced points.
+    """
+    denominator = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(denominator < 0, 0.5 * (left - right) / denominator, 0.0)
+    return np.clip(offset, -0.5, 0.5)
@@ -2,7 +2,17 @@ import os
 import requests
 from bs4 import BeautifulSoup
 
-def download_fits(inputs):
+
+def list_fits_urls(inputs):
+    """
+    This function lists the URLs of all the calibrated FFI files for a given sector, year, day, camera and CCD.
+
+    Parameters:
+    - inputs: A dictionary with the 'sector', 'year', 'day', 'camera' and 'ccd' keys.
+
+    The function scrapes the MAST directory listing with BeautifulSoup and returns the list of '.fits' links that
+    contain 'ffic' (calibrated full frame images), in the order they appear on the page.
+    """
     # The URL of the directory containing the files.
     url = f"https://archive.stsci.edu/missions/tess/ffi/s{inputs['sector']}/{inputs['year']}/{inputs['day']}/{inputs['camera']}-{inputs['ccd']}/"
 
@@ -16,18 +26,34 @@ def download_fits(inputs):
     # Find all links on the webpage
     links = soup.find_all('a')
 
-    # Download the .fits files
+    urls = []
     for link in links:
         href = link.get('href')
         if href.endswith('.fits') and ('ffic' in href):
             # Complete the URL if it's a relative URL
             if not href.startswith('http'):
                 href = url + href
-            # Send a new request to download the file
-            r = requests.get(href, stream=True)
-            r.raise_for_status()
-
-            # Write the file
-            with open(os.path.join("FITS2020_2_2   ", href.split('/')[-1]), 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
\ No newline at end of file
+            urls.append(href)
+    return urls
+
+
+def download_file(href, directory):
+    """
+    This function downloads a single FITS file into a directory and returns the local path of the file.
+    """
+    # Send a new request to download the file
+    r = requests.get(href, stream=True)
+    r.raise_for_status()
+
+    # Write the file
+    path = os.path.join(directory, href.split('/')[-1])
+    with open(path, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=8192):
+            f.write(chunk)
+    return path
+
+
+def download_fits(inputs):
+    # Download the .fits files
+    for href in list_fits_urls(inputs):
+        download_file(href, "FITS2020_2_2   ")
@@ -0,0 +1,167 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.time import Time
+from astropy.wcs import WCS
+
+# Header keywords of the linear part of the WCS of the frame. The full WCS, with the SIP distortion terms of the
+# TESS FFIs, is stored serialized in the 'wcs' column.
+WCS_KEYWORDS = ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']
+
+
+def read_frame_header(fits_file):
+    """
+    This function reads the header values of a single FFI file that are needed by the later stages.
+
+    Parameters:
+    - fits_file: The path to the FITS file.
+
+    Only the header blocks are read: with lazy_load_hdus the pixel data is skipped and never loaded into memory.
+    The function returns a dictionary with the file name, camera, CCD, observation times, exposure, gains, quality
+    flags and WCS keywords. Missing keywords are stored as None. The 'wcs' value is the full WCS of the image,
+    including the SIP distortion coefficients, as a FITS header string.
+    """
+    with fits.open(fits_file, mode='readonly', lazy_load_hdus=True) as hdu:
+        primary = hdu[0].header
+        image = hdu[1].header
+
+        row = {
+            'file': fits_file,
+            'sector': primary.get('SECTOR'),
+            'camera': primary.get('CAMERA', image.get('CAMERA')),
+            'ccd': primary.get('CCD', image.get('CCD')),
+            'date_obs': primary.get('DATE-OBS'),
+            'date_end': primary.get('DATE-END'),
+            'tstart': primary.get('TSTART'),  # BTJD - Barycentric TESS Julian Date (BJD - 2457000)
+            'tstop': primary.get('TSTOP'),
+            'exposure': image.get('EXPOSURE'),  # exposure time in days, corrected for dead time
+            'gain_a': image.get('GAINA'),
+            'gain_b': image.get('GAINB'),
+            'gain_c': image.get('GAINC'),
+            'gain_d': image.get('GAIND'),
+            'quality': image.get('DQUALITY', 0),  # data quality flags (bit mask)
+        }
+        for keyword in WCS_KEYWORDS:
+            row[keyword.lower()] = image.get(keyword)
+        row['wcs'] = WCS(image).to_header(relax=True).tostring()
+    return row
+
+
+def build_frame_index(fits_files, n_threads=8, save_path='calibrated_data'):
+    """
+    This function builds a table with the header values of all the FFI files and saves it to frame_index.csv.
+
+    Parameters:
+    - fits_files: The paths to the FITS files.
+    - n_threads: The number of files whose headers are read at the same time.
+    - save_path: The directory where the index is saved.
+
+    The headers are read in parallel with read_frame_header. The observation times are converted to MJD in one
+    vectorized astropy Time call for all frames, instead of one call per frame, and the mid-exposure time is given
+    in BTJD. The exposure time (TSTOP - TSTART, as used in the photometry) and the mean gain are added too.
+    The table is ordered by observation time and returned as a pandas DataFrame.
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        rows = []
+        for fits_file, row in zip(fits_files, pool.map(_read_frame_header_safe, fits_files)):
+            if row is None:
+                print(f"Failed to read the header of {fits_file}")
+            else:
+                rows.append(row)
+
+    index = pd.DataFrame(rows, columns=_index_columns())
+    index['exposure_time'] = index['tstop'] - index['tstart']
+    index['btjd_mid'] = (index['tstart'] + index['tstop']) / 2
+    index['gain'] = index[['gain_a', 'gain_b', 'gain_c', 'gain_d']].mean(axis=1)
+    index['quality'] = index['quality'].fillna(0).astype(int)
+
+    # Convert all the observation times at once
+    index['mjd_obs'] = _to_mjd(index['date_obs'])
+    index['mjd_end'] = _to_mjd(index['date_end'])
+
+    index = index.sort_values('mjd_obs', kind='stable').reset_index(drop=True)
+
+    os.makedirs(save_path, exist_ok=True)  # Create the directory if it doesn't exist
+    index.to_csv(os.path.join(save_path, 'frame_index.csv'), index=False)
+    return index
+
+
+def load_frame_index(save_path='calibrated_data'):
+    """
+    This function loads the frame index saved by build_frame_index.
+    """
+    return pd.read_csv(os.path.join(save_path, 'frame_index.csv'))
+
+
+def select_frames(index, start=None, stop=None, camera=None, ccd=None, quality_mask=None):
+    """
+    This function selects frames from the frame index and returns them ordered by observation time.
+
+    Parameters:
+    - index: The frame index DataFrame.
+    - start, stop: Only keep the frames observed between these MJD values (inclusive), if given.
+    - camera, ccd: Only keep the frames of this camera / CCD, if given.
+    - quality_mask: Drop the frames whose quality flags have any of these bits set, if given.
+    """
+    keep = np.ones(len(index), dtype=bool)
+    if start is not None:
+        keep &= index['mjd_obs'].to_numpy() >= start
+    if stop is not None:
+        keep &= index['mjd_obs'].to_numpy() <= stop
+    if camera is not None:
+        keep &= index['camera'].to_numpy() == int(camera)
+    if ccd is not None:
+        keep &= index['ccd'].to_numpy() == int(ccd)
+    if quality_mask is not None:
+        keep &= (index['quality'].to_numpy().astype(int) & quality_mask) == 0
+    return index[keep].sort_values('mjd_obs', kind='stable')
+
+
+def frame_wcs(row):
+    """
+    This function builds the WCS object of a frame from its row in the frame index, without opening the FITS file.
+    Indexes built before the 'wcs' column was added only have the linear WCS keywords (no SIP distortion).
+    """
+    if 'wcs' in row and not pd.isna(row['wcs']):
+        return WCS(fits.Header.fromstring(row['wcs']))
+    header = fits.Header()
+    for keyword in WCS_KEYWORDS:
+        value = row[keyword.lower()]
+        if not pd.isna(value):
+            header[keyword] = value
+    return WCS(header)
+
+
+def frame_values(row):
+    """
+    This function returns the exposure time, mean gain, observation date and MJD of the start and end of a frame
+    from its row in the frame index, in the same order as FFIStarFinder.read_frame_values.
+    """
+    return row['exposure_time'], row['gain'], row['date_obs'], row['mjd_obs'], row['mjd_end']
+
+
+def _read_frame_header_safe(fits_file):
+    try:
+        return read_frame_header(fits_file)
+    except Exception:
+        return None
+
+
+def _index_columns():
+    columns = ['file', 'sector', 'camera', 'ccd', 'date_obs', 'date_end', 'tstart', 'tstop', 'exposure',
+               'gain_a', 'gain_b', 'gain_c', 'gain_d', 'quality']
+    return columns + [keyword.lower() for keyword in WCS_KEYWORDS] + ['wcs']
+
+
+def _to_mjd(dates):
+    """
+    This function converts a column of ISO dates to MJD with a single Time object. Missing dates become NaN.
+    """
+    mjd = np.full(len(dates), np.nan)
+    present = dates.notna().to_numpy()
+    if present.any():
+        mjd[present] = Time(list(dates[present]), format='isot', scale='utc').mjd
+    return mjd
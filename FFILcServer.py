@@ -0,0 +1,264 @@
+import glob
+import io
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow output is optional
+    pa = None
+
+# Columns of a light curve, in the binary (npy / Arrow) outputs
+LIGHTCURVE_DTYPE = [('MJD_OBS', 'f8'), ('flux', 'f8'), ('flux_error', 'f8'), ('ra', 'f8'), ('dec', 'f8')]
+
+
+class NotFoundError(LookupError):
+    """
+    This exception is raised when a query names a star that is not in the photometry (HTTP 404).
+    """
+
+
+class LightcurveStore:
+    """
+    This class keeps the photometry of all the frames in memory and builds light curves from it.
+
+    Parameters:
+    - directory: The directory with the photometry_results_*.csv files.
+    - cache_size: The number of light curves kept in the LRU (least recently used) cache.
+    - max_distance: The largest distance, in degrees, between the requested position and the star of a frame.
+
+    The CSV files are read once. All the rows go into one table with a KD-tree on the unit vectors of their (ra, dec),
+    so a light curve is a single tree query instead of a scan of every file, and max_distance is the same angle in
+    every direction, at any declination and across RA = 0/360. The light curve columns are kept as NumPy arrays and
+    the rows of each TIC ID are indexed once, so a query only reads its own rows. Recently requested light curves
+    are kept in a cache.
+    """
+
+    def __init__(self, directory='photometry_results', cache_size=256, max_distance=0.01):
+        self.cache_size = cache_size
+        self.max_distance = max_distance
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        frames = []
+        for i, csv_file in enumerate(sorted(glob.glob(f'{directory}/photometry_results_*.csv'))):
+            df = pd.read_csv(csv_file)
+            df['frame'] = i
+            frames.append(df)
+        if not frames:
+            raise FileNotFoundError(f"No photometry_results_*.csv files in {directory}")
+        self.rows = pd.concat(frames, ignore_index=True)
+        self.n_frames = len(frames)
+        self.columns = {name: self.rows[name].to_numpy(dtype=np.float64) for name, _ in LIGHTCURVE_DTYPE}
+        self.frames = self.rows['frame'].to_numpy()
+        self.tree = cKDTree(unit_vectors(self.columns['ra'], self.columns['dec']))
+        self.tic_rows = self.rows.groupby('tic').indices if 'tic' in self.rows else None
+
+        # The star IDs are the photometry 'id' of the first frame in time
+        first_time = self.rows['MJD_OBS'].min()
+        self.reference = self.rows[self.rows['MJD_OBS'] == first_time].set_index('id')
+
+    def by_position(self, ra, dec):
+        """
+        This method returns the light curve of the star closest to (ra, dec): for each frame, the star closest to the
+        position (within max_distance), ordered by time.
+        """
+        return self._cached(('radec', round(float(ra), 7), round(float(dec), 7)), lambda: self._build(ra, dec))
+
+    def by_tic(self, tic):
+        """
+        This method returns the light curve of a TIC ID. The photometry must have a 'tic' column (see add_tic_ids).
+        """
+        if self.tic_rows is None:
+            raise KeyError("The photometry has no 'tic' column")
+        return self._cached(('tic', int(tic)), lambda: self._select(self.tic_rows.get(int(tic), [])))
+
+    def by_star_id(self, star_id):
+        """
+        This method returns the light curve of the star with the given photometry 'id' in the first frame.
+        """
+        star_id = int(star_id)
+        if star_id not in self.reference.index:
+            raise NotFoundError(f"Star {star_id} is not in the first frame")
+        star = self.reference.loc[star_id]
+        return self.by_position(star['ra'], star['dec'])
+
+    def query(self, params):
+        """
+        This method returns the light curve for a query dictionary with 'ra' and 'dec', 'tic' or 'star_id'.
+        """
+        if not isinstance(params, dict):
+            raise ValueError("A query must be a JSON object")
+        if 'tic' in params:
+            return self.by_tic(params['tic'])
+        if 'star_id' in params:
+            return self.by_star_id(params['star_id'])
+        if 'ra' in params and 'dec' in params:
+            return self.by_position(float(params['ra']), float(params['dec']))
+        raise KeyError("A query needs 'ra' and 'dec', 'tic' or 'star_id'")
+
+    def stats(self):
+        return {'frames': self.n_frames, 'rows': len(self.rows), 'cached': len(self.cache), 'hits': self.hits,
+                'misses': self.misses}
+
+    def _cached(self, key, build):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+        lightcurve = build()
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = lightcurve
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return lightcurve
+
+    def _build(self, ra, dec):
+        # The chord between two unit vectors an angle d apart is 2 sin(d / 2)
+        center = unit_vectors(ra, dec)
+        idx = np.asarray(self.tree.query_ball_point(center, 2 * np.sin(np.radians(self.max_distance) / 2)),
+                         dtype=int)
+        if len(idx) == 0:
+            return np.zeros(0, dtype=LIGHTCURVE_DTYPE)
+        # Keep the closest row of each frame
+        distances = np.linalg.norm(self.tree.data[idx] - center, axis=1)
+        frames = self.frames[idx]
+        order = np.lexsort((distances, frames))
+        _, first = np.unique(frames[order], return_index=True)
+        return self._select(idx[order[first]])
+
+    def _select(self, idx):
+        idx = np.asarray(idx, dtype=int)
+        idx = idx[np.argsort(self.columns['MJD_OBS'][idx], kind='stable')]
+        lightcurve = np.zeros(len(idx), dtype=LIGHTCURVE_DTYPE)
+        for name, _ in LIGHTCURVE_DTYPE:
+            lightcurve[name] = self.columns[name][idx]
+        return lightcurve
+
+
+def unit_vectors(ra, dec):
+    """
+    This function returns the (x, y, z) unit vectors of sky positions given in degrees.
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def encode_lightcurves(lightcurves, fmt):
+    """
+    This function encodes a list of light curves and returns the (content type, body) of the response.
+
+    - json: a list of {column: values} objects.
+    - npy: a single light curve as a NumPy structured array (.npy), several as a .npz with keys lc_0, lc_1, ...
+    - arrow: an Arrow IPC stream with a 'query' column giving the index of the light curve of each row.
+    """
+    if fmt == 'json':
+        body = [{name: lightcurve[name].tolist() for name, _ in LIGHTCURVE_DTYPE} for lightcurve in lightcurves]
+        return 'application/json', json.dumps(body).encode()
+    if fmt == 'npy':
+        buffer = io.BytesIO()
+        if len(lightcurves) == 1:
+            np.save(buffer, lightcurves[0])
+        else:
+            np.savez(buffer, **{f'lc_{i}': lightcurve for i, lightcurve in enumerate(lightcurves)})
+        return 'application/octet-stream', buffer.getvalue()
+    if fmt == 'arrow':
+        if pa is None:
+            raise ValueError("pyarrow is not installed")
+        columns = {'query': np.concatenate([np.full(len(lc), i) for i, lc in enumerate(lightcurves)])}
+        for name, _ in LIGHTCURVE_DTYPE:
+            columns[name] = np.concatenate([lightcurve[name] for lightcurve in lightcurves])
+        table = pa.table(columns)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return 'application/vnd.apache.arrow.stream', sink.getvalue().to_pybytes()
+    raise ValueError(f"Unknown format '{fmt}', choose json, npy or arrow")
+
+
+def make_handler(store):
+    """
+    This function returns the HTTP request handler class that answers from the given LightcurveStore.
+
+    - GET /lightcurve?ra=..&dec=.. (or ?tic=.. or ?star_id=..)&format=json|npy|arrow: one light curve.
+    - POST /lightcurves with a JSON body {"queries": [{"ra": .., "dec": ..}, {"tic": ..}, ...], "format": ..}:
+      several light curves in one request.
+    - GET /stats: the number of frames and the cache statistics.
+
+    An invalid request (or an empty batch) gets a 400 answer, and a star_id that is not in the first frame a 404.
+    """
+
+    class LightcurveHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path == '/stats':
+                self._send(200, 'application/json', json.dumps(store.stats()).encode())
+            elif url.path == '/lightcurve':
+                self._answer([params], params.get('format', 'json'))
+            else:
+                self._send(404, 'text/plain', b'Not found')
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/lightcurves':
+                self._send(404, 'text/plain', b'Not found')
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                self._send(400, 'text/plain', b'Invalid JSON body')
+                return
+            if not isinstance(body, dict) or not isinstance(body.get('queries'), list) or not body['queries']:
+                self._send(400, 'text/plain', b'The body must be a JSON object with a non-empty "queries" list')
+                return
+            self._answer(body['queries'], body.get('format', 'json'))
+
+        def _answer(self, queries, fmt):
+            try:
+                lightcurves = [store.query(query) for query in queries]
+                content_type, payload = encode_lightcurves(lightcurves, fmt)
+            except NotFoundError as e:
+                self._send(404, 'text/plain', str(e).encode())
+                return
+            except (KeyError, ValueError, TypeError) as e:
+                self._send(400, 'text/plain', str(e.args[0] if e.args else e).encode())
+                return
+            self._send(200, content_type, payload)
+
+        def _send(self, status, content_type, payload):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass  # keep the console quiet
+
+    return LightcurveHandler
+
+
+def serve(directory='photometry_results', host='127.0.0.1', port=8000, cache_size=256):
+    """
+    This function loads the photometry results and serves light curves over HTTP until interrupted (Ctrl+C).
+    """
+    store = LightcurveStore(directory, cache_size)
+    server = ThreadingHTTPServer((host, port), make_handler(store))
+    print(f"Serving {store.n_frames} frames on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
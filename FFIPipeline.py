@@ -0,0 +1,206 @@
+import asyncio
+import os
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from tqdm import tqdm
+
+import FFIDownloader as dffi
+import FFICalibrate as cffi
+import FFIStarFinder as sffi
+import FFITriage as tffi
+import FFISharedFrames as shf
+from FFIConfig import DEFAULT_CONFIG
+
+# Marks the end of the stream in the queues between the stages
+_DONE = None
+
+
+def fetch_frame(href, directory):
+    """
+    This function downloads a FFI file unless it is already in the directory, and returns its local path.
+    """
+    path = os.path.join(directory, href.split('/')[-1])
+    if not os.path.exists(path):
+        path = dffi.download_file(href, directory)
+    return (path,)
+
+
+def triage_frame(fits_file, allow_flagged=False):
+    """
+    This function drops a frame (returns None) when FFITriage classifies it as unusable, so that it never reaches
+    the calibration and photometry stages.
+    """
+    if not tffi.is_usable(fits_file, allow_flagged):
+        print(f"Skipping {fits_file}")
+        return None
+    return (fits_file,)
+
+
+def load_frame(ring, fits_file):
+    """
+    This function reads a FFI file into a free slot of the shared memory FrameRing (waiting for one if they are all
+    in use), and returns the ring spec and slot with the header values the photometry needs.
+
+    The image is read once, straight into the shared memory; only the spec and slot number, the header values and
+    the WCS keywords (a few kilobytes) are sent to the worker process.
+    """
+    with fits.open(fits_file, mode='readonly') as hdu:
+        ring.allocate(hdu[1].data.shape)
+        slot = ring.acquire()
+        try:
+            ring.view(slot)[...] = hdu[1].data
+            values = sffi.read_frame_values(hdu)
+            wcs_header = hdu[1].header.tostring()
+        except Exception:
+            ring.release(slot)
+            raise
+    return ring.spec, slot, fits_file, values, wcs_header
+
+
+def measure_frame(spec, slot, fits_file, values, wcs_header, config=DEFAULT_CONFIG):
+    """
+    This function estimates the background, finds the stars and performs the photometry of the image in a slot of
+    the shared memory FrameRing with the given spec. It runs in a worker process.
+
+    The image is a NumPy view of the shared memory, not a copy. The photometry table is returned as a structured
+    array (see FFISharedFrames.table_to_records) with the observation date, which is all the output stage needs.
+    """
+    data = shf.attach(spec)[slot]
+    mean, median, std = cffi.background_stats(data, config.sigma)
+    result = sffi.process_frame(None, data, median, std, config, values)
+    wcs = WCS(fits.Header.fromstring(wcs_header))
+    phot_table = sffi.build_photometry_table(result, fits_file, config, wcs)
+    return shf.table_to_records(phot_table), values[2]
+
+
+async def _run_stage(func, in_queue, out_queue, executor, n_tasks, release=None):
+    """
+    This function runs one stage of the pipeline: n_tasks consumers take (index, args) items from in_queue, run
+    func(*args) in the executor and put (index, result) items into out_queue. A result of None drops the frame.
+    If given, release(*args) is called once func is done with a frame, whether it succeeded or not (to give back
+    its shared memory slot).
+
+    Because the queues are bounded, a stage that falls behind makes the stages before it wait instead of piling up
+    frames in memory. A frame that fails is reported and dropped, the rest of the stream keeps going.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def worker():
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                # Put the marker back so the sibling consumers also stop
+                await in_queue.put(_DONE)
+                return
+            i, args = item
+            try:
+                value = await loop.run_in_executor(executor, func, *args)
+            except Exception as e:
+                print(f"Failed to process frame {i}: {e}")
+                continue
+            finally:
+                if release is not None:
+                    release(*args)
+            if value is not None:
+                await out_queue.put((i, value))
+
+    await asyncio.gather(*(worker() for _ in range(n_tasks)))
+    await out_queue.put(_DONE)
+
+
+async def _feed(items, out_queue):
+    for i, args in enumerate(items):
+        await out_queue.put((i, args))
+    await out_queue.put(_DONE)
+
+
+async def _write_results(in_queue, io_pool, output_directory, progress):
+    loop = asyncio.get_running_loop()
+    n_written = 0
+    while True:
+        item = await in_queue.get()
+        if item is _DONE:
+            return n_written
+        i, (records, date_obs) = item
+        phot_table = shf.records_to_table(records, date_obs)
+        await loop.run_in_executor(io_pool, sffi.save_photometry_table, phot_table, i, output_directory)
+        n_written += 1
+        progress.update(1)
+
+
+async def _pipeline(urls, fits_files, directory, output_directory, queue_size, n_downloads, n_workers,
+                    config, triage):
+    download_queue = asyncio.Queue(maxsize=queue_size)
+    triage_queue = asyncio.Queue(maxsize=queue_size)
+    load_queue = asyncio.Queue(maxsize=queue_size)
+    measure_queue = asyncio.Queue(maxsize=queue_size)
+    output_queue = asyncio.Queue(maxsize=queue_size)
+
+    total = len(urls) if urls is not None else len(fits_files)
+    n_workers = n_workers or os.cpu_count()
+    # Enough slots for the frames being measured, waiting in the queue, and being loaded
+    with shf.FrameRing(n_workers + queue_size + 1) as ring, \
+            ThreadPoolExecutor(max_workers=n_downloads + 3) as io_pool, \
+            ProcessPoolExecutor(max_workers=n_workers) as cpu_pool, \
+            tqdm(total=total) as progress:
+        # With triage, the frames go through the triage stage before they are loaded
+        first_queue = triage_queue if triage else load_queue
+        if urls is not None:
+            tasks = [
+                _feed([(href, directory) for href in urls], download_queue),
+                _run_stage(fetch_frame, download_queue, first_queue, io_pool, n_downloads),
+            ]
+        else:
+            tasks = [_feed([(fits_file,) for fits_file in fits_files], first_queue)]
+        if triage:
+            tasks.append(_run_stage(triage_frame, triage_queue, load_queue, io_pool, 1))
+        tasks += [
+            _run_stage(partial(load_frame, ring), load_queue, measure_queue, io_pool, 1),
+            _run_stage(partial(measure_frame, config=config), measure_queue, output_queue, cpu_pool, n_workers,
+                       release=lambda spec, slot, *_: ring.release(slot)),
+        ]
+        results = await asyncio.gather(*tasks, _write_results(output_queue, io_pool, output_directory, progress))
+    return results[-1]
+
+
+def run_pipeline(inputs, directory='FITS', output_directory='photometry_results', queue_size=4, n_downloads=2,
+                 n_workers=None, config=DEFAULT_CONFIG, triage=True):
+    """
+    This function downloads, calibrates and performs photometry on the FFI files of a given sector, year, day,
+    camera and CCD as a streaming pipeline.
+
+    Parameters:
+    - inputs: A dictionary with the 'sector', 'year', 'day', 'camera' and 'ccd' keys (see FFIDownloader).
+    - directory: The directory where the FFI files are downloaded to. Files already there are not downloaded again.
+    - output_directory: The directory where the photometry CSV files are written.
+    - queue_size: The maximum number of frames waiting between two stages.
+    - n_downloads: The number of files downloaded at the same time.
+    - n_workers: The number of processes used for the calibration and photometry (defaults to the number of CPUs).
+    - config: The PhotometryConfig with the background, detection and aperture parameters (see FFIConfig).
+    - triage: If True, the frames that FFITriage classifies as unusable are dropped right after the download.
+
+    Unlike running options 1-3 of main.py one after the other, each frame moves on to the background estimation,
+    star detection/photometry and output as soon as it is downloaded. The downloads and the writing of the results
+    run in threads driven by asyncio, the CPU heavy stages run in a process pool, and the stages are connected by
+    bounded queues. The total run time is therefore close to the time of the slowest stage instead of the sum of
+    all stages. The photometry of the i-th file in the MAST listing is saved as photometry_results_{i}.csv.
+
+    The function returns the number of frames written.
+    """
+    urls = dffi.list_fits_urls(inputs)
+    os.makedirs(directory, exist_ok=True)
+    return asyncio.run(_pipeline(urls, None, directory, output_directory, queue_size, n_downloads, n_workers,
+                                 config, triage))
+
+
+def run_local_pipeline(fits_files, output_directory='photometry_results', queue_size=4, n_workers=None,
+                       config=DEFAULT_CONFIG, triage=True):
+    """
+    This function runs the calibration, photometry and output stages of run_pipeline on FFI files that are already
+    on disk. The photometry of fits_files[i] is saved as photometry_results_{i}.csv.
+    """
+    return asyncio.run(_pipeline(None, fits_files, None, output_directory, queue_size, 0, n_workers, config,
+                                 triage))
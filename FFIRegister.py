@@ -0,0 +1,126 @@
+import numpy as np
+
+
+def select_patches(data, sources, n_patches=16, size=32):
+    """
+    This function chooses the bright, isolated stars used to register the frames.
+
+    Parameters:
+    - data: A 2D numpy array representing the reference image.
+    - sources: The detections of the reference image, with 'xcentroid', 'ycentroid' and 'flux' columns.
+    - n_patches: The number of patches.
+    - size: The size, in pixels, of the square patches.
+
+    The brightest sources are taken first, skipping those too close to the edge of the image and those whose patch
+    would overlap a patch already chosen. The function returns the (row, column) corners of the patches as an
+    (n_patches, 2) integer array.
+    """
+    half = size // 2
+    rows, cols = np.shape(data)
+    order = np.argsort(-np.asarray(sources['flux']))
+    x = np.rint(np.asarray(sources['xcentroid'])[order]).astype(int)
+    y = np.rint(np.asarray(sources['ycentroid'])[order]).astype(int)
+
+    corners = []
+    for yc, xc in zip(y, x):
+        y0, x0 = yc - half, xc - half
+        if y0 < 0 or x0 < 0 or y0 + size > rows or x0 + size > cols:
+            continue
+        if any(abs(y0 - cy) < size and abs(x0 - cx) < size for cy, cx in corners):
+            continue
+        corners.append((y0, x0))
+        if len(corners) == n_patches:
+            break
+    if not corners:
+        raise ValueError("No star is far enough from the edges to register the frames")
+    return np.array(corners, dtype=int)
+
+
+def cut_patches(data, corners, size=32):
+    """
+    This function returns the (n_patches, size, size) patches of an image at the given corners.
+    """
+    offsets = np.arange(size)
+    patches = np.asarray(data)[corners[:, 0, None, None] + offsets[None, :, None],
+                               corners[:, 1, None, None] + offsets[None, None, :]]
+    return np.nan_to_num(patches.astype(np.float64))
+
+
+def patch_spectra(patches):
+    """
+    This function returns the 2D Fourier transforms of the patches, after subtracting their median background.
+
+    The patches are centred on stars, so their edges are at the background level and no window is applied (a window
+    fixed on the patch would weight a shifted star asymmetrically and bias the sub-pixel shift).
+    """
+    return np.fft.rfft2(patches - np.median(patches, axis=(1, 2), keepdims=True))
+
+
+def estimate_shift(reference_spectra, patches):
+    """
+    This function estimates the sub-pixel shift of a frame relative to the reference frame.
+
+    Parameters:
+    - reference_spectra: The patch_spectra of the reference frame.
+    - patches: The patches of the frame, at the same corners as the reference.
+
+    The cross-power spectra of all the patches are summed, so the cross-correlation is that of all the stars
+    together, and transformed back with one inverse FFT. The integer shift is the peak of the cross-correlation;
+    the sub-pixel part is the vertex of a Gaussian (a parabola through the logarithms) fitted to the peak and its
+    two neighbours, along each axis. The function returns (dx, dy): a star at (x, y) in the reference frame is at
+    (x + dx, y + dy) in this frame.
+    """
+    size = patches.shape[-1]
+    cross = np.sum(patch_spectra(patches) * np.conj(reference_spectra), axis=0)
+    correlation = np.fft.fftshift(np.fft.irfft2(cross, s=(size, size)))
+
+    py, px = np.unravel_index(np.argmax(correlation), correlation.shape)
+    dy = py - size // 2 + _peak_offset(correlation[(py - 1) % size, px], correlation[py, px],
+                                       correlation[(py + 1) % size, px])
+    dx = px - size // 2 + _peak_offset(correlation[py, (px - 1) % size], correlation[py, px],
+                                       correlation[py, (px + 1) % size])
+    return dx, dy
+
+
+def register_frames(data_arrays, sources, reference=0, n_patches=16, size=32):
+    """
+    This function estimates the shift of every frame relative to a reference frame.
+
+    Parameters:
+    - data_arrays: The image data of each frame, e.g. the memory-mapped calibrated stack.
+    - sources: The detections of the reference frame.
+    - reference: The index of the reference frame.
+    - n_patches, size: The number and size of the bright star patches (see select_patches).
+
+    Only the patches are read from each frame, so registering a frame costs a few small FFTs instead of a full
+    detection. When the shift is a pixel or more, the patches are cut again, moved by the integer part of the shift,
+    and only the remaining fraction is estimated, so the stars stay centred in the patches as the pointing drifts.
+    The function returns an (n_frames, 2) array of (dx, dy) shifts.
+    """
+    corners = select_patches(data_arrays[reference], sources, n_patches, size)
+    reference_spectra = patch_spectra(cut_patches(data_arrays[reference], corners, size))
+    rows, cols = np.shape(data_arrays[reference])
+
+    shifts = []
+    for data in data_arrays:
+        dx, dy = estimate_shift(reference_spectra, cut_patches(data, corners, size))
+        step = np.rint([dy, dx]).astype(int)
+        moved = corners + step
+        if np.any(step) and moved.min() >= 0 and np.all(moved + size <= [rows, cols]):
+            dx, dy = estimate_shift(reference_spectra, cut_patches(data, moved, size))
+            dx, dy = dx + step[1], dy + step[0]
+        shifts.append((dx, dy))
+    return np.array(shifts)
+
+
+def _peak_offset(left, center, right):
+    """
+    This function returns the offset of the vertex of a Gaussian through three equally spaced points, or of a
+    parabola when the points are not all positive.
+    """
+    if left > 0 and center > 0 and right > 0:
+        left, center, right = np.log(left), np.log(center), np.log(right)
+    denominator = left - 2 * center + right
+    if denominator >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (left - right) / denominator, -0.5, 0.5))
@@ -0,0 +1,108 @@
+import queue
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+from astropy.table import Table
+
+import FFIStarFinder as sffi
+
+# Shared memory blocks attached by this process, by name: they stay open for the life of the worker process
+_attached = {}
+
+
+class FrameRing:
+    """
+    This class is a ring of frame slots in shared memory, used to hand the images to the worker processes without
+    copying or pickling them.
+
+    Parameters:
+    - n_slots: The number of frames that can be in flight at the same time.
+
+    The shared memory is allocated by the first allocate call, when the shape of the images is known. A producer
+    takes a free slot with acquire (it waits while all the slots are in use), writes the image into view(slot), and
+    sends the slot number and spec to a worker, which gets a NumPy view of the same memory with attach(spec)[slot].
+    The slot is given back with release once the worker is done with it. Use it as a context manager so the shared
+    memory is freed at the end.
+    """
+
+    def __init__(self, n_slots):
+        self.n_slots = n_slots
+        self.shm = None
+        self.frames = None
+        self.spec = None
+        self.free = queue.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+        self.lock = threading.Lock()
+
+    def allocate(self, shape, dtype=np.float32):
+        """
+        This method creates the shared memory for n_slots images of the given shape, on the first call. Later calls
+        only check that the shape is the same.
+        """
+        with self.lock:
+            if self.shm is None:
+                dtype = np.dtype(dtype)
+                self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots * int(np.prod(shape)) *
+                                                      dtype.itemsize)
+                self.frames = np.ndarray((self.n_slots,) + tuple(shape), dtype=dtype, buffer=self.shm.buf)
+                self.spec = (self.shm.name, self.n_slots, tuple(shape), dtype.str)
+            elif tuple(shape) != self.frames.shape[1:]:
+                raise ValueError(f"image shape {tuple(shape)} differs from {self.frames.shape[1:]}")
+
+    def acquire(self):
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def view(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        if self.shm is not None:
+            self.frames = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(spec):
+    """
+    This function returns the (n_slots, rows, columns) NumPy view of the FrameRing with the given spec. The shared
+    memory is opened once per process and then reused.
+    """
+    name, n_slots, shape, dtype = spec
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray((n_slots,) + shape, dtype=dtype, buffer=shm.buf))
+    return _attached[name][1]
+
+
+def table_to_records(table):
+    """
+    This function converts the numeric columns of a photometry table to a NumPy structured array, which is sent back
+    from the worker processes instead of the table (with its units and metadata).
+    """
+    names = [name for name in table.colnames if table[name].dtype.kind in 'biuf']
+    records = np.zeros(len(table), dtype=[(name, table[name].dtype.str) for name in names])
+    for name in names:
+        records[name] = np.asarray(table[name])
+    return records
+
+
+def records_to_table(records, date_obs):
+    """
+    This function rebuilds the photometry table from the records of a frame and its observation date (the 'time'
+    column, the only one that is not numeric).
+    """
+    table = Table(records)
+    table.add_column(sffi.format_time(date_obs), name='time', index=table.colnames.index('MJD_OBS'))
+    return table
@@ -6,15 +6,22 @@ import numpy as np
 from astropy.io import fits  # for handling FITS files
 from astropy.stats import sigma_clipped_stats  # for statistical operations on data
 
-from photutils.detection import DAOStarFinder
 from photutils.aperture import CircularAperture, aperture_photometry  # for photometry tasks
 import pandas as pd
 from datetime import datetime
 from astropy.wcs import WCS  # World Coordinate System (WCS)
 from astropy.time import Time
+from astropy.table import Table
 from astroquery.mast import Catalogs  # for querying the Mikulski Archive for Space Telescopes (MAST)
 import time
 import os
+import tracemalloc
+
+import FFIDetector as dtf
+import FFIRegister as rffi
+import FFIApertures as fap
+import FFIHeaderIndex as hffi
+from FFIConfig import DEFAULT_CONFIG
 
 def closest_source(sources, position):
     """
@@ -108,13 +115,14 @@ def optimal_radius(fluxes, radii):
     slopes = [fluxes[i + 1] - fluxes[i] for i in range(len(fluxes) - 1)]
     optimal_idx = np.argmin(slopes)
     return radii[optimal_idx + 1]
-def perform_photometry(data, sources):
+def perform_photometry(data, sources, radii=DEFAULT_CONFIG.growth_radii):
     """
     This function performs aperture photometry on an image for a given list of sources.
 
     Parameters:
     - data: A 2D numpy array representing the image data.
     - sources: A table of identified sources, where each source has 'xcentroid' and 'ycentroid' properties.
+    - radii: The aperture radii of the curve of growth.
 
     The zip function combines the 'xcentroid' and 'ycentroid' arrays into pairs of coordinates,
     and list converts it into a list of tuples.
@@ -123,7 +131,6 @@ def perform_photometry(data, sources):
 
 
     positions = list(zip(sources['xcentroid'], sources['ycentroid']))
-    radii = range(1, 10)
 
     # Generate curve of growth
     fluxes = curve_of_growth(data, positions, radii)
@@ -188,7 +195,79 @@ def format_time(time_string):
     return classic_time
 
 
-def process_fits_file(fits_files,data_arrays, means, medians, stds):
+def read_frame_values(hdu):
+    """
+    This function reads the exposure time, the mean gain of the 4 amplifiers, the observation date and the MJD of
+    the start and end of the observation from the header of an opened FITS file.
+    """
+    # Calculate the exposure time
+    exposure_time = hdu[0].header['TSTOP'] - hdu[0].header['TSTART']
+
+    # Extract the gain from the header
+    gainA = hdu[1].header['GAINA']
+    gainB = hdu[1].header['GAINB']
+    gainC = hdu[1].header['GAINC']
+    gainD = hdu[1].header['GAIND']
+    gain = (gainA + gainB + gainC + gainD) / 4  # (5.2) This is an approximate value for TESS
+
+    # get the header
+    header = hdu[0].header
+    date_obs = header['DATE-OBS']
+    date_end = header['DATE-END']
+
+    mjd_obs = Time(date_obs, format='isot', scale='utc').mjd
+    mjd_end = Time(date_end, format='isot', scale='utc').mjd
+    return exposure_time, gain, date_obs, mjd_obs, mjd_end
+
+
+def process_frame(hdu, data, median, std, config=None, values=None, sources=None):
+    """
+    This function finds the sources in a single image and performs photometry on them.
+
+    Parameters:
+    - hdu: The opened FITS file the image comes from, used for the header values.
+    - data: A 2D numpy array representing the image data.
+    - median: The median background level of the image.
+    - std: The standard deviation of the background noise in the image.
+    - config: The PhotometryConfig with the detector backend, its parameters and the aperture radii
+      (FFIConfig.DEFAULT_CONFIG if None).
+    - values: The read_frame_values of the file, if they were already read (then hdu is not used).
+    - sources: The detections of the image, if they were already found (then the detector is not run).
+
+    The function returns the same tuple as one entry of the process_fits_file results list.
+    """
+    config = config or DEFAULT_CONFIG
+
+    # Find the stars in the image
+    if sources is None:
+        sources = detect_sources(data, median, std, config)
+
+    # Perform aperture photometry
+    phot_table = perform_photometry(data, sources, config.growth_radii)
+
+    exposure_time, gain, date_obs, mjd_obs, mjd_end = values or read_frame_values(hdu)
+
+    # Calculate the flux and add it to the photometry table
+    phot_table = calculate_flux(phot_table, exposure_time)
+
+    # Estimate the number of pixels in the aperture
+    n_pixels = np.pi * config.aperture_radius ** 2  # This assumes a circular aperture
+
+    # Calculate the flux error and add it to the photometry table
+    phot_table = calculate_flux_error(phot_table, n_pixels, median, gain, std)
+
+    return phot_table, sources, exposure_time, n_pixels, median, gain, std, data, date_obs, mjd_obs, mjd_end
+
+
+def detect_sources(data, median, std, config=None):
+    """
+    This function finds the stars in an image with the detector backend and parameters of the config.
+    """
+    config = config or DEFAULT_CONFIG
+    return dtf.get_detector(config.detector)(data, median, std, fwhm=config.fwhm, threshold=config.threshold)
+
+
+def process_fits_file(fits_files,data_arrays, means, medians, stds, config=None):
     """
     This function processes a FITS file and performs photometry on the sources found in the image.
 
@@ -207,111 +286,261 @@ def process_fits_file(fits_files,data_arrays, means, medians, stds):
     results = []
 
     for fits_file, data_array, mean, median, std in zip(fits_files, data_arrays, means, medians, stds):
-    # Open the FITS file
-     with fits.open(fits_file) as hdu:
-        data = data_array
-
-        """
-        The DAOStarFinder class implements the DAOFIND algorithm (Stetson, 1987) which uses a wavelet transform of 
-        the input image to calculate the local mean and standard deviation, and then selects sources where the 
-        wavelet-transformed image is larger than a certain threshold above the local background.
-        The FWHM=5.0 (Full Width at Half Maximum) is a measure of the extent of a function, given by the difference 
-        between the two extreme values of the independent variable at which the dependent variable is equal to half of 
-        its maximum value.
-        The threshold=3. (limit for detection of the stars) is a value above which a star will be detected
-        This means that for a local peak to be considered a star, it must be at least 3 standard deviations brighter
-        than the background
-        """
-        # Find the stars in the image
-        daofind = DAOStarFinder(fwhm=5.0, threshold=3. * std)  # fwhm can be modified
-        sources = daofind(data - median)
-
-        # Perform aperture photometry
-        phot_table = perform_photometry(data, sources)
-
-
-
-        # Calculate the exposure time
-        exposure_time = hdu[0].header['TSTOP'] - hdu[0].header['TSTART']
-
-        # Calculate the flux and add it to the photometry table
-        phot_table = calculate_flux(phot_table, exposure_time)
-
-        # Estimate the number of pixels in the aperture
-        n_pixels = np.pi * 3 ** 2  # This assumes a circular aperture with a radius of 3 pixels
-
-        # Extract the gain from the header
-        gainA = hdu[1].header['GAINA']
-        gainB = hdu[1].header['GAINB']
-        gainC = hdu[1].header['GAINC']
-        gainD = hdu[1].header['GAIND']
-        gain = (gainA + gainB + gainC + gainD) / 4  # (5.2) This is an approximate value for TESS
-
-        # Calculate the flux error and add it to the photometry table
-        phot_table = calculate_flux_error(phot_table, n_pixels, median, gain, std)
-
-        # get the header
-        header = hdu[0].header
-        date_obs = header['DATE-OBS']
-        date_end = header['DATE-END']
-
-        mjd_obs = Time(date_obs, format='isot', scale='utc').mjd
-        mjd_end = Time(date_end, format='isot', scale='utc').mjd
-        # Save all the values as a tuple to the results list
-        results.append((phot_table, sources, exposure_time, n_pixels, median, gain, std, data, date_obs, mjd_obs, mjd_end))
-
-        # Remember to include data in the returned tuple
+        # Open the FITS file
+        with fits.open(fits_file) as hdu:
+            # Save all the values as a tuple to the results list
+            results.append(process_frame(hdu, data_array, median, std, config))
+
     return results
 
 
-def find_stars(fits_files, data_arrays, means, medians, stds):
-    # loop for each data_arrays, means, medians, stds
-    results = process_fits_file(fits_files, data_arrays, means, medians, stds)
-    i = 0
-    print(len(fits_files))
-    # for for results and fit_files
-    for result, fits_file in zip(results, fits_files):
+def build_photometry_table(result, fits_file, config=None, wcs=None):
+    """
+    This function builds the final photometry table of a single image from one entry of the process_fits_file
+    results list.
 
-        phot_table, sources, exposure_time, n_pixels, median, gain, std, data, date_obs, mjd_obs, mjd_end = result
-        # Perform aperture photometry on all stars
-        positions = [(source['xcentroid'], source['ycentroid']) for source in sources]
-        apertures = CircularAperture(positions, r=3.)
-        phot_table = aperture_photometry(data, apertures)
+    The function redoes the aperture photometry with a fixed radius (config.aperture_radius, 3 pixels by default),
+    adds the observation time, converts the pixel positions to RA and Dec with the WCS of the FITS file, and adds the
+    flux, flux error and the comparison to the background level. If the WCS object is given, the FITS file is not
+    opened again.
+    """
+    config = config or DEFAULT_CONFIG
+    phot_table, sources, exposure_time, n_pixels, median, gain, std, data, date_obs, mjd_obs, mjd_end = result
+    # Perform aperture photometry on all stars
+    positions = [(source['xcentroid'], source['ycentroid']) for source in sources]
+    apertures = CircularAperture(positions, r=config.aperture_radius)
+    phot_table = aperture_photometry(data, apertures)
 
-        # Add the time of the observation to the photometry table
-        phot_table['time'] = format_time(date_obs)
-        phot_table['MJD_OBS'] = mjd_obs  # MJD - Modified Julian Date of Observation
+    # Add the time of the observation to the photometry table
+    phot_table['time'] = format_time(date_obs)
+    phot_table['MJD_OBS'] = mjd_obs  # MJD - Modified Julian Date of Observation
 
+    if wcs is None:
         with fits.open(fits_file) as hdu:
             # Initialize the WCS object
-            w = WCS(hdu[1].header)
+            wcs = WCS(hdu[1].header)
 
-            # Convert pixel coordinates to celestial coordinates
-            positions = list(zip(sources['xcentroid'], sources['ycentroid']))
-            world_coords = w.all_pix2world(positions, 0)
-            ra = world_coords[:, 0]
-            dec = world_coords[:, 1]
+    # Convert pixel coordinates to celestial coordinates
+    positions = list(zip(sources['xcentroid'], sources['ycentroid']))
+    world_coords = wcs.all_pix2world(positions, 0)
+    ra = world_coords[:, 0]
+    dec = world_coords[:, 1]
 
-            # Add RA and DEC to the photometry table
-            phot_table['ra'] = ra
-            phot_table['dec'] = dec
+    # Add RA and DEC to the photometry table
+    phot_table['ra'] = ra
+    phot_table['dec'] = dec
 
-        # Calculate the flux and flux error for all stars
-        phot_table = calculate_flux(phot_table, exposure_time)
-        phot_table = calculate_flux_error(phot_table, n_pixels, median, gain, std)
+    # Calculate the flux and flux error for all stars
+    phot_table = calculate_flux(phot_table, exposure_time)
+    phot_table = calculate_flux_error(phot_table, n_pixels, median, gain, std)
 
-        # Compare aperture sum to background level
-        phot_table = compare_to_background(phot_table, median)
+    # Compare aperture sum to background level
+    phot_table = compare_to_background(phot_table, median)
+    return phot_table
 
-        # Create the directory if it does not exist
-        directory = 'photometry_results'
-        if not os.path.exists(directory):
-            os.makedirs(directory)
 
-        # Save the photometry results to a CSV file
-        phot_table.to_pandas().to_csv(f'{directory}/photometry_results_{i}.csv', index=False)
+def save_photometry_table(phot_table, i, directory='photometry_results'):
+    """
+    This function saves the photometry table of the i-th image to a CSV file in the given directory.
+    """
+    # Create the directory if it does not exist
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
 
-        i = i + 1
-        print(i)
-    return "Find stars in the calibrated images."
+    # Save the photometry results to a CSV file
+    phot_table.to_pandas().to_csv(f'{directory}/photometry_results_{i}.csv', index=False)
+
+
+def measure_memory(function, *args):
+    """
+    This function calls function(*args) and returns its result with the peak memory, in bytes, allocated during the
+    call, as traced by tracemalloc (which includes the NumPy arrays). Tracing slows the call down several times, so
+    it is used to measure one image, not all of them.
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    try:
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    return result, peak
+
+
+def photometry_memory(hdu, fits_file, data, median, std, config=None, size=1024):
+    """
+    This function measures the peak memory of the two stages of the photometry of an image, with measure_memory, on
+    a size x size cutout at its centre (a whole image is several times slower to trace than to process).
+
+    The function returns the peak memory of the detection per byte of image and of the photometry (curve of growth,
+    aperture photometry and final table) per detected source. If the cutout has too few stars for the second, the
+    whole image is measured instead.
+    """
+    config = config or DEFAULT_CONFIG
+    rows, cols = np.shape(data)
+    if min(rows, cols) > size:
+        r0, c0 = (rows - size) // 2, (cols - size) // 2
+        data = np.array(data[r0:r0 + size, c0:c0 + size])
+    data = np.asarray(data)
+    wcs = WCS(hdu[1].header)
+
+    sources, detection_peak = measure_memory(detect_sources, data, median, std, config)
+    n_sources = 0 if sources is None else len(sources)
+    if n_sources < 100 and data.shape != (rows, cols):
+        return photometry_memory(hdu, fits_file, data, median, std, config, size=max(rows, cols))
+    _, photometry_peak = measure_memory(lambda: build_photometry_table(
+        process_frame(hdu, data, median, std, config, sources=sources), fits_file, config, wcs))
+    return detection_peak / data.nbytes, photometry_peak / max(n_sources, 1)
+
+
+def iter_photometry(fits_files, data_arrays, medians, stds, max_memory_mb=1024, config=None):
+    """
+    This function finds the stars and performs photometry one image at a time, and yields a (fits_file, phot_table)
+    tuple for each image as soon as it is ready.
 
+    Parameters:
+    - fits_files: The paths to the FITS files.
+    - data_arrays: The image data of each file. Any iterable works, e.g. an array loaded with np.load(mmap_mode='r')
+      or a generator, so only the current image has to be in memory.
+    - medians: The median background level of each image.
+    - stds: The standard deviation of the background noise of each image.
+    - max_memory_mb: The memory cap, in megabytes, for processing a single image.
+    - config: The PhotometryConfig to use (FFIConfig.DEFAULT_CONFIG if None).
+
+    Unlike process_fits_file, nothing is kept from one image to the next: the image, the sources table and the
+    intermediate tables are released before the next image is loaded, so the memory use does not grow with the
+    number of images.
+
+    The memory of each stage is estimated before it runs, from photometry_memory measured once on the first image:
+    the detection from the size of the image, and the photometry from the number of stars just detected, so a
+    crowded image is caught before its photometry. A MemoryError is raised when an estimate is over max_memory_mb.
+    """
+    config = config or DEFAULT_CONFIG
+    max_bytes = max_memory_mb * 1024 ** 2
+    per_byte = per_source = None
+
+    def check(fits_file, needed, stage):
+        if needed > max_bytes:
+            raise MemoryError(f"{fits_file} needs about {needed / 1024 ** 2:.0f} MB for the {stage}, "
+                              f"more than the {max_memory_mb} MB cap")
+
+    for fits_file, data_array, median, std in zip(fits_files, data_arrays, medians, stds):
+        # Load this image (and only this image) into memory
+        data = np.asarray(data_array)
+        with fits.open(fits_file) as hdu:
+            if per_byte is None:
+                per_byte, per_source = photometry_memory(hdu, fits_file, data, median, std, config)
+
+            check(fits_file, per_byte * data.nbytes, 'detection')
+            sources = detect_sources(data, median, std, config)
+            check(fits_file, per_source * (0 if sources is None else len(sources)), 'photometry')
+            result = process_frame(hdu, data, median, std, config, sources=sources)
+            phot_table = build_photometry_table(result, fits_file, config, WCS(hdu[1].header))
+
+        del result, sources, data
+        yield fits_file, phot_table
+
+
+def stream_photometry(fits_files, data_arrays, medians, stds, sink=save_photometry_table, max_memory_mb=1024,
+                      config=None):
+    """
+    This function writes the photometry of each image to the sink as soon as it is yielded by iter_photometry.
+
+    The sink is called as sink(phot_table, i) for the i-th image; by default the table is saved to
+    photometry_results/photometry_results_{i}.csv. The function returns the number of images written.
+    """
+    n_written = 0
+    for i, (fits_file, phot_table) in enumerate(iter_photometry(fits_files, data_arrays, medians, stds,
+                                                                max_memory_mb, config)):
+        sink(phot_table, i)
+        n_written += 1
+        print(n_written)
+    return n_written
+
+
+def forced_photometry(fits_files, data_arrays, medians, stds, config=None, reference=0,
+                      directory='photometry_results', save_path='calibrated_data', tolerance=0.05, block_size=16,
+                      frame_index=None):
+    """
+    This function performs photometry at fixed sky positions: the stars are detected once, on a reference image, and
+    followed in the other images with the frame shifts from FFIRegister instead of being detected again.
+
+    Parameters:
+    - fits_files: The paths to the FITS files.
+    - data_arrays: The image data of each file, e.g. the memory-mapped calibrated stack.
+    - medians: The median background level of each image.
+    - stds: The standard deviation of the background noise of each image.
+    - config: The PhotometryConfig to use (FFIConfig.DEFAULT_CONFIG if None).
+    - reference: The index of the reference image.
+    - directory: The directory where the photometry tables are saved.
+    - save_path: The directory where the shifts are saved as frame_shifts.csv.
+    - tolerance: The largest difference, in pixels, between the shift of an image and the shift the aperture
+      weights used for it were computed for.
+    - block_size: The number of images measured together.
+    - frame_index: The frame index of the files (see FFIHeaderIndex). If None, it is built for fits_files.
+
+    The apertures of each image are the reference positions moved by the (dx, dy) shift of the image, and the RA and
+    Dec of the stars come from the WCS of the reference image, so the 'id' of a star is the same in every table. The
+    images are measured in blocks of images with (almost) the same shift, with one product of a sparse matrix of
+    aperture weights (see FFIApertures) for the whole block; the weights are only computed again when the shift
+    moves by more than tolerance. The tables have the same columns as build_photometry_table, plus the shift of the
+    image. The header values (times, exposure, gain) and the WCS come from the frame index, so the FITS files are
+    not opened. The function returns the shifts.
+    """
+    config = config or DEFAULT_CONFIG
+    if frame_index is None:
+        frame_index = hffi.build_frame_index(fits_files, save_path=save_path)
+    frames = frame_index.drop_duplicates('file').set_index('file', drop=False).loc[list(fits_files)]
+
+    reference_data = np.asarray(data_arrays[reference])
+    sources = dtf.get_detector(config.detector)(reference_data, medians[reference], stds[reference],
+                                                fwhm=config.fwhm, threshold=config.threshold)
+    reference_positions = np.column_stack([sources['xcentroid'], sources['ycentroid']])
+    world_coords = hffi.frame_wcs(frames.iloc[reference]).all_pix2world(reference_positions, 0)
+
+    shifts = rffi.register_frames(data_arrays, sources, reference)
+    os.makedirs(save_path, exist_ok=True)  # Create the directory if it doesn't exist
+    pd.DataFrame({'file': fits_files, 'dx': shifts[:, 0], 'dy': shifts[:, 1]}).to_csv(
+        os.path.join(save_path, 'frame_shifts.csv'), index=False)
+
+    n_pixels = np.pi * config.aperture_radius ** 2  # This assumes a circular aperture
+    apertures = fap.ApertureMatrix(config.aperture_radius, reference_data.shape, tolerance)
+    for start, stop, anchor in fap.frame_blocks(shifts, tolerance, block_size):
+        apertures.set_positions(reference_positions + shifts[anchor])
+        aperture_sums = apertures.photometry(data_arrays[start:stop])
+
+        for i in range(start, stop):
+            exposure_time, gain, date_obs, mjd_obs, mjd_end = hffi.frame_values(frames.iloc[i])
+
+            # the positions of the stars in this image; the apertures are within tolerance of them
+            positions = reference_positions + shifts[i]
+            phot_table = Table()
+            phot_table['id'] = np.arange(1, len(positions) + 1)
+            phot_table['xcenter'] = positions[:, 0]
+            phot_table['ycenter'] = positions[:, 1]
+            phot_table['aperture_sum'] = aperture_sums[i - start]
+            phot_table['time'] = format_time(date_obs)
+            phot_table['MJD_OBS'] = mjd_obs  # MJD - Modified Julian Date of Observation
+            phot_table['ra'] = world_coords[:, 0]
+            phot_table['dec'] = world_coords[:, 1]
+
+            phot_table = calculate_flux(phot_table, exposure_time)
+            phot_table = calculate_flux_error(phot_table, n_pixels, medians[i], gain, stds[i])
+            phot_table = compare_to_background(phot_table, medians[i])
+            phot_table['dx'], phot_table['dy'] = shifts[i]
+            save_photometry_table(phot_table, i, directory)
+
+    print(f"{len(sources)} stars in {len(fits_files)} images, largest shift {np.abs(shifts).max():.2f} pixels, "
+          f"aperture weights computed {apertures.updates} times")
+    return shifts
+
+
+def find_stars(fits_files, data_arrays, means, medians, stds, config=None):
+    print(len(fits_files))
+    # write the photometry of each image as soon as it is ready
+    stream_photometry(fits_files, data_arrays, medians, stds, config=config)
+    return "Find stars in the calibrated images."
@@ -0,0 +1,269 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from FFILcServer import unit_vectors
+
+# Columns of the per-sector photometry store, one row per star and frame, sorted by star_id
+STORE_DTYPE = [('star_id', 'i8'), ('MJD_OBS', 'f8'), ('flux', 'f8'), ('flux_error', 'f8'), ('ra', 'f8'),
+               ('dec', 'f8'), ('frame', 'i4')]
+INDEX_COLUMNS = ['star_id', 'sector', 'camera', 'ccd', 'file', 'start', 'stop']
+
+
+class LightcurveStitcher:
+    """
+    This class merges the photometry of several sectors (and cameras/CCDs) into one lightcurve per star.
+
+    Parameters:
+    - store_path: The directory of the store: one .npy file per ingested sector/camera/CCD, the index
+      (stitch_index.csv) and the master catalog (master_catalog.csv) with the star ID, position and TIC ID (if
+      known) of every star.
+    - match_radius: The largest distance, in degrees, between a detection and a catalog star (0.006 degrees is about
+      one TESS pixel). The catalog is searched on the unit vectors of the positions, so it is the same angle at
+      every declination and across RA = 0/360.
+
+    Each sector is ingested once (ingest_sector): its rows are given the star ID of the master catalog, found from
+    their TIC ID or from their position, sorted by star ID and saved as a NumPy structured array. The index gives, for
+    every star and sector, the slice [start, stop) of its rows in the sector file. Stitching a star (stitch) reads
+    only these slices, memory-mapped, instead of scanning the photometry of every sector.
+    """
+
+    def __init__(self, store_path='stitch_store', match_radius=0.006):
+        self.store_path = store_path
+        self.match_radius = match_radius
+        # The chord between two unit vectors an angle d apart is 2 sin(d / 2)
+        self.match_chord = 2 * np.sin(np.radians(match_radius) / 2)
+        os.makedirs(store_path, exist_ok=True)  # Create the directory if it doesn't exist
+        self.index_path = os.path.join(store_path, 'stitch_index.csv')
+        self.catalog_path = os.path.join(store_path, 'master_catalog.csv')
+
+        if os.path.exists(self.index_path):
+            self.index = pd.read_csv(self.index_path)
+        else:
+            self.index = pd.DataFrame(columns=INDEX_COLUMNS)
+        if os.path.exists(self.catalog_path):
+            self.catalog = pd.read_csv(self.catalog_path)
+            if 'tic' not in self.catalog:
+                self.catalog['tic'] = pd.NA
+            self.catalog['tic'] = self.catalog['tic'].astype('Int64')
+        else:
+            self.catalog = pd.DataFrame({'star_id': np.zeros(0, dtype=np.int64), 'ra': np.zeros(0),
+                                         'dec': np.zeros(0), 'tic': pd.array([], dtype='Int64')})
+
+    def ingest_sector(self, directory, sector, camera, ccd, id_column=None):
+        """
+        This method adds the photometry of one sector/camera/CCD to the store, replacing a previous ingestion of it.
+
+        Parameters:
+        - directory: The directory with the photometry_results_*.csv files of the sector.
+        - sector, camera, ccd: The provenance of the photometry.
+        - id_column: The column with the TIC IDs (e.g. 'tic', see add_tic_ids), or None.
+
+        The star IDs are those of the master catalog, they are never TIC IDs. A row with a TIC ID gets the star with
+        that TIC ID; a TIC ID that is not in the catalog yet is given to the closest catalog star without a TIC ID
+        (e.g. the same star ingested by position from another sector), or to a new star. The rows without a TIC ID
+        are matched by position to the master catalog, and the stars that are not in it yet are added with new IDs.
+
+        The function returns the number of stars of the sector.
+        """
+        frames = []
+        for csv_file in sorted(glob.glob(f'{directory}/photometry_results_*.csv')):
+            df = pd.read_csv(csv_file)
+            df['frame'] = int(os.path.splitext(csv_file)[0].rsplit('_', 1)[1])
+            frames.append(df)
+        if not frames:
+            raise FileNotFoundError(f"No photometry_results_*.csv files in {directory}")
+        rows = pd.concat(frames, ignore_index=True)
+
+        star_ids = np.zeros(len(rows), dtype=np.int64)
+        distances = np.zeros(len(rows))
+        has_tic = rows[id_column].notna().to_numpy() if id_column is not None else np.zeros(len(rows), dtype=bool)
+        if has_tic.any():
+            star_ids[has_tic] = self._match_tics(rows[has_tic], rows.loc[has_tic, id_column].to_numpy(np.int64))
+        if not has_tic.all():
+            star_ids[~has_tic], distances[~has_tic] = self._match_catalog(rows[~has_tic])
+
+        # Keep the closest detection of each star in each frame
+        order = np.lexsort((distances, rows['frame'].to_numpy(), star_ids))
+        keys = np.column_stack([star_ids[order], rows['frame'].to_numpy()[order]])
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+        order = order[first]
+
+        table = np.zeros(len(order), dtype=STORE_DTYPE)
+        table['star_id'] = star_ids[order]
+        for name, _ in STORE_DTYPE[1:]:
+            table[name] = rows[name].to_numpy()[order]
+
+        file_name = f'sector_{sector}_{camera}-{ccd}.npy'
+        np.save(os.path.join(self.store_path, file_name), table)
+
+        # One index row per star: the slice of its rows in the sector file
+        ids, start, counts = np.unique(table['star_id'], return_index=True, return_counts=True)
+        sector_index = pd.DataFrame({'star_id': ids, 'sector': sector, 'camera': camera, 'ccd': ccd,
+                                     'file': file_name, 'start': start, 'stop': start + counts})
+        self.index = pd.concat([self.index[self.index['file'] != file_name], sector_index], ignore_index=True)
+        self.index.to_csv(self.index_path, index=False)
+        self.catalog.to_csv(self.catalog_path, index=False)
+        print(f"Sector {sector} camera {camera} CCD {ccd}: {len(ids)} stars, {len(table)} measurements")
+        return len(ids)
+
+    def find_tic(self, tic):
+        """
+        This method returns the star ID of a TIC ID, or None if it is not in the master catalog.
+        """
+        star = self.catalog[self.catalog['tic'] == int(tic)]
+        return int(star['star_id'].iloc[0]) if len(star) else None
+
+    def find_star(self, ra, dec):
+        """
+        This method returns the ID of the master catalog star closest to (ra, dec), or None if there is none within
+        match_radius.
+        """
+        if len(self.catalog) == 0:
+            return None
+        tree = cKDTree(unit_vectors(self.catalog['ra'].to_numpy(), self.catalog['dec'].to_numpy()))
+        distance, i = tree.query(unit_vectors(ra, dec))
+        return int(self.catalog['star_id'].iloc[i]) if distance <= self.match_chord else None
+
+    def sectors(self, star_id):
+        """
+        This method returns the index rows (sector, camera, ccd, file, slice) of a star.
+        """
+        return self.index[self.index['star_id'] == int(star_id)]
+
+    def stitch(self, star_id, normalize=True):
+        """
+        This method returns the lightcurve of a star over all the ingested sectors, ordered by time.
+
+        Parameters:
+        - star_id: The master catalog ID of the star (see find_star and find_tic).
+        - normalize: Divide the flux and the flux error of each sector by the median flux of the star in that sector,
+          so that sectors observed with different cameras/CCDs line up around 1.
+
+        The lightcurve is a DataFrame with MJD_OBS, flux, flux_error, ra, dec, the provenance columns sector, camera,
+        ccd and frame, and the raw_flux and raw_flux_error before normalization.
+        """
+        parts = []
+        for entry in self.sectors(star_id).itertuples():
+            rows = np.load(os.path.join(self.store_path, entry.file), mmap_mode='r')[int(entry.start):int(entry.stop)]
+            part = pd.DataFrame({name: np.asarray(rows[name]) for name, _ in STORE_DTYPE})
+            part['sector'], part['camera'], part['ccd'] = entry.sector, entry.camera, entry.ccd
+            part['raw_flux'] = part['flux']
+            part['raw_flux_error'] = part['flux_error']
+            if normalize:
+                scale = np.nanmedian(part['raw_flux'])
+                scale = scale if scale > 0 else np.nan
+                part['flux'] = part['raw_flux'] / scale
+                part['flux_error'] = part['raw_flux_error'] / scale
+            parts.append(part)
+        if not parts:
+            raise KeyError(f"Star {star_id} is not in the index")
+        return pd.concat(parts, ignore_index=True).sort_values('MJD_OBS', ignore_index=True)
+
+    def _next_ids(self, n):
+        next_id = int(self.catalog['star_id'].max()) + 1 if len(self.catalog) else 1
+        return np.arange(next_id, next_id + n, dtype=np.int64)
+
+    def _match_tics(self, rows, tics):
+        """
+        This method returns the star ID of each row from its TIC ID, adding the TIC IDs that are not in the master
+        catalog yet (see ingest_sector).
+        """
+        # The mean position of each TIC ID, averaged as unit vectors so it is right across RA = 0/360
+        vectors = pd.DataFrame(unit_vectors(rows['ra'].to_numpy(), rows['dec'].to_numpy()), columns=['x', 'y', 'z'])
+        vectors = vectors.groupby(tics).mean()
+        vectors = vectors.div(np.linalg.norm(vectors.to_numpy(), axis=1), axis=0)
+        new = pd.DataFrame({'ra': np.degrees(np.arctan2(vectors['y'], vectors['x'])) % 360,
+                            'dec': np.degrees(np.arcsin(np.clip(vectors['z'], -1, 1)))}, index=vectors.index)
+        new = new[~new.index.isin(self.catalog['tic'].dropna())]
+
+        free = self.catalog[self.catalog['tic'].isna()]
+        matched = np.zeros(len(new), dtype=bool)
+        if len(new) and len(free):
+            d, i = cKDTree(unit_vectors(free['ra'].to_numpy(), free['dec'].to_numpy())).query(
+                unit_vectors(new['ra'].to_numpy(), new['dec'].to_numpy()), distance_upper_bound=self.match_chord)
+            # each catalog star takes at most one TIC ID, the closest
+            for k in np.argsort(d):
+                if np.isfinite(d[k]) and not np.any(i[matched] == i[k]):
+                    matched[k] = True
+                    self.catalog.loc[free.index[i[k]], 'tic'] = int(new.index[k])
+
+        added = new[~matched]
+        self.catalog = pd.concat([self.catalog, pd.DataFrame({
+            'star_id': self._next_ids(len(added)), 'ra': added['ra'].to_numpy(), 'dec': added['dec'].to_numpy(),
+            'tic': pd.array(added.index, dtype='Int64')})], ignore_index=True)
+
+        known = self.catalog.dropna(subset=['tic'])
+        star_of_tic = pd.Series(known['star_id'].to_numpy(), index=known['tic'].to_numpy(np.int64))
+        return star_of_tic.loc[tics].to_numpy(np.int64)
+
+    def _match_catalog(self, rows):
+        """
+        This method gives every row the ID of the closest master catalog star, frame by frame in time order. The
+        detections that match no star are added to the catalog, so they are matched in the next frames.
+        """
+        star_ids = np.zeros(len(rows), dtype=np.int64)
+        distances = np.zeros(len(rows))
+        positions = rows[['ra', 'dec']].to_numpy()
+        vectors = unit_vectors(positions[:, 0], positions[:, 1])
+        catalog_ids = self.catalog['star_id'].to_numpy(dtype=np.int64)
+        catalog_positions = self.catalog[['ra', 'dec']].to_numpy(dtype=np.float64)
+        catalog_vectors = unit_vectors(catalog_positions[:, 0], catalog_positions[:, 1])
+        tree = cKDTree(catalog_vectors) if len(catalog_ids) else None
+
+        times = rows.groupby('frame')['MJD_OBS'].min().sort_values()
+        frame_column = rows['frame'].to_numpy()
+        for frame in times.index:
+            idx = np.nonzero(frame_column == frame)[0]
+            if tree is not None:
+                d, i = tree.query(vectors[idx], distance_upper_bound=self.match_chord)
+            else:
+                d, i = np.full(len(idx), np.inf), np.zeros(len(idx), dtype=int)
+            matched = np.isfinite(d)
+            star_ids[idx[matched]] = catalog_ids[i[matched]]
+            distances[idx[matched]] = d[matched]
+
+            new = idx[~matched]
+            if len(new):
+                next_id = catalog_ids.max() + 1 if len(catalog_ids) else 1
+                new_ids = np.arange(next_id, next_id + len(new))
+                star_ids[new] = new_ids
+                catalog_ids = np.concatenate([catalog_ids, new_ids])
+                catalog_positions = np.concatenate([catalog_positions, positions[new]])
+                catalog_vectors = np.concatenate([catalog_vectors, vectors[new]])
+                tree = cKDTree(catalog_vectors)
+
+        n_known = len(self.catalog)
+        self.catalog = pd.concat([self.catalog, pd.DataFrame({
+            'star_id': catalog_ids[n_known:], 'ra': catalog_positions[n_known:, 0],
+            'dec': catalog_positions[n_known:, 1], 'tic': pd.array([pd.NA] * (len(catalog_ids) - n_known),
+                                                                    dtype='Int64')})], ignore_index=True)
+        return star_ids, distances
+
+
+def ingest_sector(directory, sector, camera, ccd, store_path='stitch_store', id_column=None):
+    """
+    This function adds the photometry of one sector/camera/CCD to the store (see LightcurveStitcher.ingest_sector).
+    """
+    return LightcurveStitcher(store_path).ingest_sector(directory, sector, camera, ccd, id_column)
+
+
+def stitch_lightcurve(star_ra, star_dec, store_path='stitch_store', save_path='lightcurves'):
+    """
+    This function stitches the lightcurve of the star closest to (star_ra, star_dec) over all the ingested sectors
+    and saves it to lightcurves/stitched_<star_id>.csv.
+    """
+    stitcher = LightcurveStitcher(store_path)
+    star_id = stitcher.find_star(star_ra, star_dec)
+    if star_id is None:
+        print(f"No star at RA={star_ra}, Dec={star_dec} in the master catalog")
+        return None
+    lightcurve = stitcher.stitch(star_id)
+    os.makedirs(save_path, exist_ok=True)  # Create the directory if it doesn't exist
+    lightcurve.to_csv(os.path.join(save_path, f'stitched_{star_id}.csv'), index=False)
+    print(f"Star {star_id}: {len(lightcurve)} points in {lightcurve['sector'].nunique()} sectors")
+    return lightcurve
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.table import Table
+from photutils.aperture import CircularAperture, aperture_photometry
+
+import FFICalibrate as cffi
+import FFIDetector as dtf
+import FFIStarFinder as sffi
+
+# Columns of the detections kept in the cache, enough to place the apertures and to compare the detectors
+DETECTION_COLUMNS = ['xcentroid', 'ycentroid', 'sharpness', 'roundness2', 'peak', 'flux', 'mag']
+
+
+class SweepCache:
+    """
+    This class stores the intermediate results of the photometry as .npy files, keyed by the file and the parameters
+    that produced them.
+
+    Parameters:
+    - directory: The directory of the cache. It can be kept between sweeps.
+
+    The key of an entry is a hash of the absolute path, modification time and size of the FITS file (so a changed
+    file is recomputed) and of the parameters. The 'hits' and 'misses' counters tell how much work was reused.
+    """
+
+    def __init__(self, directory='sweep_cache'):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)  # Create the directory if it doesn't exist
+
+    def get(self, kind, fits_file, params, compute):
+        """
+        This method returns the cached array of the given kind ('background', 'detections', 'aperture') for the file
+        and the parameters, or computes it with compute() and saves it.
+        """
+        path = self._path(kind, fits_file, params)
+        if os.path.exists(path):
+            self.hits += 1
+            return np.load(path)
+        self.misses += 1
+        value = compute()
+        np.save(path, value)
+        return value
+
+    def _path(self, kind, fits_file, params):
+        stat = os.stat(fits_file)
+        key = json.dumps([os.path.abspath(fits_file), stat.st_mtime_ns, stat.st_size, params], sort_keys=True)
+        return os.path.join(self.directory, f'{kind}_{hashlib.sha1(key.encode()).hexdigest()}.npy')
+
+
+def detections_to_array(sources):
+    """
+    This function converts a detection table (or None when no star was found) to a NumPy structured array.
+    """
+    dtype = [(name, 'f8') for name in DETECTION_COLUMNS]
+    if sources is None:
+        return np.zeros(0, dtype=dtype)
+    detections = np.zeros(len(sources), dtype=dtype)
+    for name in DETECTION_COLUMNS:
+        if name in sources.colnames:
+            detections[name] = sources[name]
+    return detections
+
+
+def run_sweep(fits_files, configs, cache_dir='sweep_cache', save_path='calibrated_data'):
+    """
+    This function runs the photometry of the FITS files for several configurations, reusing the intermediate results
+    that the configurations have in common.
+
+    Parameters:
+    - fits_files: The paths to the FITS files.
+    - configs: A list of PhotometryConfig (see FFIConfig.config_grid).
+    - cache_dir: The directory of the SweepCache.
+    - save_path: The directory where the summary is saved as sweep_results.csv.
+
+    Each stage is cached with only the parameters it depends on:
+    - the background statistics (mean, median, std) with sigma,
+    - the detections with sigma and the detector, fwhm and threshold,
+    - the aperture sums with the detection parameters and the aperture radius.
+    So changing only the aperture radius reuses the detections, and changing only the threshold reuses the
+    background statistics. The image is only read when one of the stages is not in the cache.
+
+    The function returns a DataFrame with one row per configuration and file: the parameters, the number of sources,
+    and the median aperture sum and signal-to-noise ratio (aperture sum / flux error, as in calculate_flux_error).
+    """
+    cache = SweepCache(cache_dir)
+    rows = []
+    for fits_file in fits_files:
+        with fits.open(fits_file, mode='readonly', memmap=True) as hdu:
+            header = hdu[1].header
+            gain = np.mean([header.get(f'GAIN{amp}', 1.0) for amp in 'ABCD'])
+            data = None
+
+            def image():
+                # the image is only read for the first stage that is not in the cache
+                nonlocal data
+                if data is None:
+                    data = np.asarray(hdu[1].data, dtype=np.float64)
+                return data
+
+            for config in configs:
+                detection_key = config.detection_key()
+                mean, median, std = cache.get('background', fits_file, config.background_key(),
+                                              lambda: np.array(cffi.background_stats(image(), config.sigma)))
+                detections = cache.get('detections', fits_file, detection_key, lambda: detections_to_array(
+                    dtf.get_detector(config.detector)(image(), median, std, fwhm=config.fwhm,
+                                                      threshold=config.threshold)))
+                aperture_sums = cache.get('aperture', fits_file,
+                                          dict(detection_key, aperture_radius=config.aperture_radius),
+                                          lambda: _aperture_sums(image(), detections, config.aperture_radius))
+
+                phot_table = Table({'aperture_sum': aperture_sums})
+                n_pixels = np.pi * config.aperture_radius ** 2
+                phot_table = sffi.calculate_flux_error(phot_table, n_pixels, median, gain, std)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    snr = np.asarray(phot_table['aperture_sum'] / phot_table['flux_error'])
+
+                rows.append(dict(config.to_dict(), file=fits_file, n_sources=len(detections),
+                                 median_aperture_sum=np.median(aperture_sums) if len(aperture_sums) else np.nan,
+                                 median_snr=np.nanmedian(snr) if len(snr) else np.nan))
+
+    results = pd.DataFrame(rows)
+    results['growth_radii'] = results['growth_radii'].astype(str)
+    os.makedirs(save_path, exist_ok=True)  # Create the directory if it doesn't exist
+    results.to_csv(os.path.join(save_path, 'sweep_results.csv'), index=False)
+    print(f"{len(configs)} configurations, {len(fits_files)} files: {cache.hits} cached, {cache.misses} computed")
+    return results
+
+
+def _aperture_sums(data, detections, radius):
+    """
+    This function returns the aperture sums of the detections, with circular apertures of the given radius.
+    """
+    if len(detections) == 0:
+        return np.zeros(0)
+    apertures = CircularAperture(np.column_stack([detections['xcentroid'], detections['ycentroid']]), r=radius)
+    return np.asarray(aperture_photometry(data, apertures)['aperture_sum'], dtype=np.float64)
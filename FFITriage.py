@@ -0,0 +1,137 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+# TESS quality flags (DQUALITY bits) of frames that cannot be used: attitude tweak, safe mode, coarse point,
+# Earth point, momentum dump (reaction wheel desaturation) and manual exclude
+REJECT_QUALITY = 1 | 2 | 4 | 8 | 32 | 128
+# Quality flags of frames that are probably bad: Argabrightening and scattered light
+FLAG_QUALITY = 16 | 2048
+
+
+def frame_stats(fits_file, step=16, grid=8, saturation_level=1e5):
+    """
+    This function measures a few cheap statistics of a single FFI file.
+
+    Parameters:
+    - fits_file: The path to the FITS file.
+    - step: Only every step-th pixel of every step-th row is read.
+    - grid: The downsampled image is split in grid x grid cells to measure the large scale gradient.
+    - saturation_level: Pixels at or above this value (e-/s) are counted as saturated.
+
+    The file is memory-mapped and only the downsampled pixels are read, so a frame takes milliseconds instead of the
+    seconds of the full photometry. The function returns a dictionary with:
+    - quality: the DQUALITY flags of the header.
+    - background: the median of the downsampled image.
+    - gradient: the spread (95th - 5th percentile) of the median of the grid cells, relative to the background.
+      Scattered light from the Earth or the Moon makes large smooth gradients across the CCD.
+    - saturated_fraction: the fraction of the downsampled pixels at or above saturation_level.
+    - readable: True (see _frame_stats_safe for the files that cannot be read).
+    """
+    with fits.open(fits_file, mode='readonly', memmap=True) as hdu:
+        quality = hdu[1].header.get('DQUALITY', 0)
+        thumb = np.array(hdu[1].data[::step, ::step], dtype=np.float32)
+
+    background = float(np.nanmedian(thumb))
+    rows, cols = (thumb.shape[0] // grid) * grid, (thumb.shape[1] // grid) * grid
+    cells = thumb[:rows, :cols].reshape(grid, rows // grid, grid, cols // grid)
+    cell_medians = np.nanmedian(cells, axis=(1, 3))
+    low, high = np.nanpercentile(cell_medians, [5, 95])
+
+    return {
+        'file': fits_file,
+        'quality': int(quality),
+        'background': background,
+        'gradient': float((high - low) / abs(background)) if background else np.inf,
+        'saturated_fraction': float(np.mean(thumb >= saturation_level)),
+        'readable': True,
+    }
+
+
+def classify_frame(stats, max_gradient=0.5, max_saturated_fraction=0.01):
+    """
+    This function classifies a frame as 'ok', 'flag' or 'reject' from its frame_stats, and gives the reasons.
+
+    A frame is rejected if its file cannot be read (e.g. a truncated download), if its quality flags are in
+    REJECT_QUALITY or if too many pixels are saturated, and flagged if its quality flags are in FLAG_QUALITY or if
+    its background has a large gradient.
+    """
+    if not stats['readable']:
+        return 'reject', 'unreadable'
+    reasons = []
+    status = 'ok'
+    if stats['quality'] & REJECT_QUALITY:
+        status = 'reject'
+        reasons.append(f"quality {stats['quality']}")
+    elif stats['quality'] & FLAG_QUALITY:
+        status = 'flag'
+        reasons.append(f"quality {stats['quality']}")
+    if stats['saturated_fraction'] > max_saturated_fraction:
+        status = 'reject'
+        reasons.append('saturated')
+    if stats['gradient'] > max_gradient:
+        status = 'flag' if status == 'ok' else status
+        reasons.append('gradient')
+    return status, ', '.join(reasons)
+
+
+def triage_frames(fits_files, n_threads=8, max_background_ratio=2.0, save_path='calibrated_data', **kwargs):
+    """
+    This function classifies all the FFI files before the expensive stages, and saves the result to triage.csv.
+
+    Parameters:
+    - fits_files: The paths to the FITS files.
+    - n_threads: The number of files read at the same time.
+    - max_background_ratio: A frame whose background is more than this times the median background of all the
+      frames is flagged (scattered light raises the whole background).
+    - save_path: The directory where triage.csv is saved.
+    - kwargs: Passed to classify_frame.
+
+    The function returns a DataFrame with the frame_stats of each file and its 'status' and 'reasons'.
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        triage = pd.DataFrame(list(pool.map(_frame_stats_safe, fits_files)))
+
+    statuses = [classify_frame(row, **kwargs) for row in triage.to_dict('records')]
+    triage['status'] = [status for status, _ in statuses]
+    triage['reasons'] = [reasons for _, reasons in statuses]
+
+    bright = triage['background'] > max_background_ratio * triage['background'].median()
+    triage.loc[bright & (triage['status'] == 'ok'), 'status'] = 'flag'
+    triage.loc[bright, 'reasons'] = [', '.join(filter(None, [reasons, 'background']))
+                                     for reasons in triage.loc[bright, 'reasons']]
+
+    os.makedirs(save_path, exist_ok=True)  # Create the directory if it doesn't exist
+    triage.to_csv(os.path.join(save_path, 'triage.csv'), index=False)
+    print(triage['status'].value_counts().to_string())
+    return triage
+
+
+def usable_frames(triage, allow_flagged=False):
+    """
+    This function returns the files of the triage table that should go through the expensive stages: the 'ok'
+    frames, plus the 'flag' frames if allow_flagged.
+    """
+    keep = triage['status'].isin(['ok', 'flag'] if allow_flagged else ['ok'])
+    return list(triage.loc[keep, 'file'])
+
+
+def is_usable(fits_file, allow_flagged=False):
+    """
+    This function triages a single frame on its own (without the comparison to the other frames' background).
+    It is used to drop frames early in the streaming pipeline.
+    """
+    status, _ = classify_frame(_frame_stats_safe(fits_file))
+    return status == 'ok' or (allow_flagged and status == 'flag')
+
+
+def _frame_stats_safe(fits_file):
+    try:
+        return frame_stats(fits_file)
+    except Exception as e:
+        print(f"Failed to read {fits_file}: {e}")
+        return {'file': fits_file, 'quality': 0, 'background': np.nan, 'gradient': np.nan,
+                'saturated_fraction': np.nan, 'readable': False}
@@ -1,12 +1,19 @@
 import glob
 import os
 
-import numpy as np
 from tqdm import tqdm
 import FFIDownloader as dffi
 import FFICalibrate as cffi
 import FFIStarFinder as sffi
 import FFILcCreator as lffi
+import FFIPipeline as pffi
+import FFIHeaderIndex as hffi
+import FFIDetector as dtf
+import FFILcServer as lcs
+import FFITriage as tffi
+import FFISweep as swp
+import FFIStitcher as stf
+from FFIConfig import DEFAULT_CONFIG, config_grid
 
 
 def print_options():
@@ -15,11 +22,73 @@ def print_options():
   cffi_desc = "Calibrate FFI files by removing noise, hot pixels, etc."
   sffi_desc = "Find stars in calibrated FFI images."
   lffi_desc = "Create lightcurves for stars of interest."
+  pffi_desc = "Download, calibrate and find stars as a streaming pipeline."
+  hffi_desc = "Index the FFI headers (times, gains, quality, WCS) without reading the images."
+  dtf_desc = "Compare the fast star detector with DAOStarFinder on the calibrated images."
+  lcs_desc = "Serve lightcurves over HTTP (JSON, NumPy, Arrow)."
+  tffi_desc = "Triage the FFI files and skip the unusable frames (momentum dumps, scattered light, etc.)."
+  swp_desc = "Sweep the detection and aperture parameters, reusing the cached intermediate results."
+  stf_ingest_desc = "Add the photometry of a sector to the multi-sector lightcurve store."
+  stf_desc = "Stitch the lightcurve of a star across all the sectors in the store."
+  rffi_desc = "Find stars on the first image and follow them with the frame shifts (no re-detection)."
 
   print(f"1) {dffi_desc}")
   print(f"2) {cffi_desc}")
   print(f"3) {sffi_desc}")
   print(f"4) {lffi_desc}")
+  print(f"5) {pffi_desc}")
+  print(f"6) {hffi_desc}")
+  print(f"7) {dtf_desc}")
+  print(f"8) {lcs_desc}")
+  print(f"9) {tffi_desc}")
+  print(f"10) {swp_desc}")
+  print(f"11) {stf_ingest_desc}")
+  print(f"12) {stf_desc}")
+  print(f"13) {rffi_desc}")
+
+
+def read_detector():
+    # ask again until the name is one of the detector backends
+    while True:
+        detector = input(f"Detector ({'/'.join(dtf.DETECTORS)}, default dao): ").strip() or 'dao'
+        try:
+            dtf.get_detector(detector)
+            return detector
+        except ValueError as e:
+            print(e)
+
+
+def read_config():
+    return DEFAULT_CONFIG.with_values(detector=read_detector())
+
+
+def read_sweep_configs():
+    # empty answers keep the default value
+    values = {}
+    for name in ['threshold', 'fwhm', 'aperture_radius']:
+        values_str = input(f"Values of {name} (comma-separated, default {getattr(DEFAULT_CONFIG, name)}): ").strip()
+        if values_str:
+            values[name] = [float(value) for value in values_str.split(',')]
+    return config_grid(read_config(), **values)
+
+
+def read_sector_inputs():
+    inputs_str = input("Enter photometry directory, sector, camera, and CCD (comma-separated): ")
+    directory, sector, camera, ccd = inputs_str.split(',')
+    return directory.strip(), int(sector), int(camera), int(ccd)
+
+
+def read_download_inputs():
+    inputs_str = input("Enter sector, year, day, camera, and CCD (comma-separated): ")
+    sector, year, day, camera, ccd = inputs_str.split(',')
+
+    return {
+        'sector': sector.strip(),
+        'year': year.strip(),
+        'day': day.strip(),
+        'camera': camera.strip(),
+        'ccd': ccd.strip()
+    }
 
 
 def main():
@@ -27,7 +96,16 @@ def main():
         "1": dffi.download_fits,
         "2": cffi.calibrate_background,
         "3": sffi.find_stars,
-        "4": lffi.create_lightcurve
+        "4": lffi.create_lightcurve,
+        "5": pffi.run_pipeline,
+        "6": hffi.build_frame_index,
+        "7": dtf.compare_detectors,
+        "8": lcs.serve,
+        "9": tffi.triage_frames,
+        "10": swp.run_sweep,
+        "11": stf.ingest_sector,
+        "12": stf.stitch_lightcurve,
+        "13": sffi.forced_photometry
     }
 
     data_arrays, means, medians, stds = None, None, None, None
@@ -38,37 +116,45 @@ def main():
     while not is_complete:
         os.system('cls' if os.name == 'nt' else 'clear')  # clear screen
         print_options()
-        selected = input("Select option (1-4): ")
+        selected = input("Select option (1-13): ")
 
         if selected in options:
             if selected == "1":
-                inputs_str = input("Enter sector, year, day, camera, and CCD (comma-separated): ")
-                sector, year, day, camera, ccd = inputs_str.split(',')
-
-                inputs = {
-                    'sector': sector.strip(),
-                    'year': year.strip(),
-                    'day': day.strip(),
-                    'camera': camera.strip(),
-                    'ccd': ccd.strip()
-                }
-                options[selected](inputs)
+                options[selected](read_download_inputs())
 
             elif selected == "2":
                options[selected](fits_files)
 
             elif selected == "3":
+                # the calibrated images of fits_files, matched by file name (the triage may have dropped some)
+                files, data_arrays, means, medians, stds = cffi.load_calibrated_data(fits_files)
 
-                save_path = 'calibrated_data'  # Directory where the files are saved
-
-                data_arrays = np.load(os.path.join(save_path, 'data_arrays.npy'))
-                means = np.load(os.path.join(save_path, 'means.npy'))
-                medians = np.load(os.path.join(save_path, 'medians.npy'))
-                stds = np.load(os.path.join(save_path, 'stds.npy'))
-
-                options[selected](fits_files, data_arrays, means, medians, stds)
+                options[selected](files, data_arrays, means, medians, stds, read_config())
             elif selected == "4":
                 options[selected]()
+            elif selected == "5":
+                options[selected](read_download_inputs(), config=read_config())
+            elif selected == "6":
+                options[selected](fits_files)
+            elif selected == "7":
+                files, data_arrays, means, medians, stds = cffi.load_calibrated_data(fits_files)
+                options[selected](files, data_arrays, medians, stds)
+            elif selected == "8":
+                options[selected]()
+            elif selected == "9":
+                # the next options only use the usable frames
+                fits_files = tffi.usable_frames(options[selected](fits_files))
+            elif selected == "10":
+                options[selected](fits_files, read_sweep_configs())
+            elif selected == "11":
+                options[selected](*read_sector_inputs())
+            elif selected == "12":
+                star_ra = float(input("Please enter the RA (Right Ascension) of the star: "))
+                star_dec = float(input("Please enter the Dec (Declination) of the star: "))
+                options[selected](star_ra, star_dec)
+            elif selected == "13":
+                files, data_arrays, means, medians, stds = cffi.load_calibrated_data(fits_files)
+                options[selected](files, data_arrays, medians, stds, read_config())
         else:
             is_complete = True
 